@@ -0,0 +1,66 @@
+"""
+Cold start time
+
+Times fresh interpreters importing the package and running `blurgenerator --help`,
+and checks that neither loads NumPy or OpenCV. Exits with 1 when a heavy module
+is loaded or a median exceeds `--max-ms`.
+
+    python benchmarks/import_time.py --repeat 10 --max-ms 150
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+# Modules that must stay unloaded until a blur runs
+heavy_modules = ['cv2', 'numpy']
+
+cases = {
+    'import': 'import blurgenerator',
+    'help': (
+        'import sys\n'
+        'from blurgenerator.cli import main\n'
+        'sys.argv = ["blurgenerator", "--help"]\n'
+        'try:\n'
+        '    main()\n'
+        'except SystemExit:\n'
+        '    pass\n'
+    ),
+}
+
+# Appended to every case to report its own duration and the heavy modules it loaded
+report_code = (
+    '\nimport time, json\n'
+    'print(json.dumps({"seconds": time.perf_counter() - start, '
+    '"loaded": [name for name in %r if name in sys.modules]}))\n'
+) % heavy_modules
+
+def run_case(code):
+    script = 'import sys, time\nstart = time.perf_counter()\n' + code + report_code
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5, help='Fresh interpreters per case, the median is reported. Default is 5.')
+    parser.add_argument('--max-ms', type=float, default=None, help='Flag cases whose median exceeds this many milliseconds.')
+    args = parser.parse_args()
+
+    report = {}
+    failed = False
+    for name, code in cases.items():
+        runs = [run_case(code) for _ in range(args.repeat)]
+        median = statistics.median(run['seconds'] for run in runs) * 1000
+        loaded = sorted(set(module for run in runs for module in run['loaded']))
+        report[name] = {'median_ms': median, 'loaded': loaded}
+        print(f'{name:<8} {median:8.2f}ms loaded: {", ".join(loaded) or "-"}', file=sys.stderr)
+        if loaded or (args.max_ms is not None and median > args.max_ms):
+            failed = True
+
+    print(json.dumps(report, indent=2))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Peak memory of lens blur
+
+Reports the wall time and the peak memory allocated through NumPy (tracked by
+`tracemalloc`) while blurring one frame, for each precision and backend.
+
+    python benchmarks/lens_memory.py --sizes 1280x720 3840x2160 --radius 10
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+from blurgenerator import lens_blur
+from blurgenerator.convolution import spectrum_cache
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def measure(img, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    lens_blur(img, **kwargs)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[(1280, 720), (1920, 1080)], help='Frame sizes as `WIDTHxHEIGHT`.')
+    parser.add_argument('--radius', type=float, default=10.0, help='Radius for lens blur. Default is 10.0.')
+    parser.add_argument('--components', type=int, default=4, help='Components for lens blur. Default is 4.')
+    parser.add_argument('--exposure_gamma', type=float, default=2.0, help='Exposure gamma for lens blur. Default is 2.0.')
+    args = parser.parse_args()
+    # Hold every spectrum of the largest frame, so none is rebuilt while measuring
+    spectrum_cache.resize(2**40)
+
+    print(f'{"size":>11} {"backend":>8} {"precision":>9} {"seconds":>8} {"peak MiB":>9} {"x frame":>8}')
+    for width, height in args.sizes:
+        img = np.random.randint(255, size=(height, width, 3), dtype=np.uint8)
+        for backend in ['spatial', 'fft']:
+            for precision in ['float32', 'float64']:
+                # Warm up the kernel and spectrum caches on the frame itself, since spectra
+                # are built per frame shape, so only the per-call cost is measured
+                spectrum_cache.clear()
+                lens_blur(img, radius=args.radius, components=args.components, exposure_gamma=args.exposure_gamma, backend=backend, precision=precision)
+                seconds, peak = measure(
+                    img,
+                    radius=args.radius,
+                    components=args.components,
+                    exposure_gamma=args.exposure_gamma,
+                    backend=backend,
+                    precision=precision
+                )
+                print(f'{width:>5}x{height:<5} {backend:>8} {precision:>9} {seconds:8.3f} {peak / 2**20:9.1f} {peak / img.nbytes:8.1f}')
+
+if __name__ == '__main__':
+    main()
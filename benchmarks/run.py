@@ -0,0 +1,190 @@
+"""
+Benchmark suite
+
+Sweeps every blur entry point across image sizes and parameters and reports wall
+time, throughput (Mpx/s) and peak memory as JSON. With `--baseline`, results are
+compared against an earlier run and regressions beyond `--threshold` are flagged.
+
+    python benchmarks/run.py --preset quick --output baseline.json
+    python benchmarks/run.py --preset quick --baseline baseline.json
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import blurgenerator
+from blurgenerator import motion_blur, lens_blur, gaussian_blur
+from blurgenerator import motion_blur_with_depth_map, lens_blur_with_depth_map, gaussian_blur_with_depth_map
+
+sizes = {
+    'VGA': (640, 480),
+    'HD': (1280, 720),
+    'FHD': (1920, 1080),
+    '4K': (3840, 2160),
+    '8K': (7680, 4320),
+}
+
+presets = {
+    'quick': ['VGA', 'HD'],
+    'full': ['VGA', 'HD', 'FHD', '4K', '8K'],
+}
+
+# Each entry is (function, default parameters, {parameter: values swept one at a time})
+suites = {
+    'lens_blur': (lens_blur, {'radius': 5.0, 'components': 4, 'exposure_gamma': 2.0}, {
+        'radius': [3.0, 10.0, 30.0],
+        'components': [1, 2, 4, 6],
+        'exposure_gamma': [1.0, 2.0, 5.0],
+    }),
+    'motion_blur': (motion_blur, {'size': 100, 'angle': 30}, {
+        'size': [20, 80, 200],
+        'angle': [0, 30, 45, 90],
+    }),
+    'gaussian_blur': (gaussian_blur, {'kernel': 100}, {
+        'kernel': [11, 51, 101, 201],
+    }),
+    'motion_blur_with_depth_map': (motion_blur_with_depth_map, {'angle': 30, 'num_layers': 10, 'min_blur': 1, 'max_blur': 50}, {
+        'num_layers': [3, 10, 30],
+    }),
+    'lens_blur_with_depth_map': (lens_blur_with_depth_map, {'components': 4, 'exposure_gamma': 2, 'num_layers': 10, 'min_blur': 1, 'max_blur': 20}, {
+        'num_layers': [3, 10, 30],
+    }),
+    'gaussian_blur_with_depth_map': (gaussian_blur_with_depth_map, {'num_layers': 10, 'min_blur': 1, 'max_blur': 50}, {
+        'num_layers': [3, 10, 30],
+    }),
+}
+
+def make_inputs(width, height):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    gray = np.tile(np.linspace(0, 255, width).astype(np.uint8), (height, 1))
+    depth_map = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    return img, depth_map
+
+def iter_cases(names):
+    '''Yield `(name, params)` for the defaults and every one-at-a-time variation'''
+    for name in names:
+        _, defaults, sweeps = suites[name]
+        seen = []
+        for parameter, values in [(None, [None])] + list(sweeps.items()):
+            for value in values:
+                params = dict(defaults)
+                if parameter is not None:
+                    params[parameter] = value
+                if params in seen:
+                    continue
+                seen.append(params)
+                yield name, params
+
+def case_id(name, size, params):
+    arguments = ','.join(f'{key}={params[key]}' for key in sorted(params))
+    return f'{name}[{size}]({arguments})'
+
+def run_case(name, params, img, depth_map, repeat):
+    function = suites[name][0]
+    args = (img, depth_map) if name.endswith('_with_depth_map') else (img,)
+
+    # Warm up caches and the worker pool
+    function(*args, **params)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **params)
+        timings.append(time.perf_counter() - start)
+
+    # Peak memory is measured in a separate run, since tracing slows allocations down
+    tracemalloc.start()
+    function(*args, **params)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = min(timings)
+    return {
+        'seconds': seconds,
+        'median_seconds': statistics.median(timings),
+        'mpx_per_s': img.shape[0] * img.shape[1] / 1e6 / seconds,
+        'peak_bytes': peak,
+    }
+
+def run(size_names, names, repeat):
+    results = []
+    for size in size_names:
+        width, height = sizes[size]
+        img, depth_map = make_inputs(width, height)
+        for name, params in iter_cases(names):
+            result = run_case(name, params, img, depth_map, repeat)
+            result.update({'id': case_id(name, size, params), 'function': name, 'size': size, 'width': width, 'height': height, 'params': params})
+            results.append(result)
+            print(f'{result["id"]:<90} {result["seconds"]:9.4f}s {result["mpx_per_s"]:9.2f} Mpx/s {result["peak_bytes"] / 2**20:9.1f} MiB', file=sys.stderr)
+    return results
+
+def compare(results, baseline, threshold):
+    '''Return the cases slower or heavier than the baseline by more than `threshold`'''
+    previous = {result['id']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['id'])
+        if before is None:
+            continue
+        for metric in ['seconds', 'peak_bytes']:
+            if before[metric] > 0 and result[metric] > before[metric] * (1 + threshold):
+                regressions.append({
+                    'id': result['id'],
+                    'metric': metric,
+                    'baseline': before[metric],
+                    'current': result[metric],
+                    'ratio': result[metric] / before[metric],
+                })
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preset', choices=sorted(presets), default='quick', help='Image sizes to sweep. `quick` is VGA and HD, `full` goes up to 8K. Default is `quick`.')
+    parser.add_argument('--sizes', nargs='+', choices=list(sizes), default=None, help='Image sizes to sweep, overriding `preset`.')
+    parser.add_argument('--functions', nargs='+', choices=list(suites), default=list(suites), help='Entry points to benchmark. Default is all of them.')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case, the fastest is reported. Default is 3.')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this path instead of stdout.')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON report of an earlier run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown or memory growth flagged as a regression. Default is 0.1.')
+    args = parser.parse_args()
+
+    results = run(args.sizes or presets[args.preset], args.functions, args.repeat)
+    report = {
+        'meta': {
+            'blurgenerator': blurgenerator.__version__,
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as fh:
+            regressions = compare(results, json.load(fh), args.threshold)
+        report['regressions'] = regressions
+        for regression in regressions:
+            print(f'REGRESSION {regression["id"]} {regression["metric"]}: {regression["baseline"]:.4g} -> {regression["current"]:.4g} (x{regression["ratio"]:.2f})', file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            fh.write(text)
+    else:
+        print(text)
+
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
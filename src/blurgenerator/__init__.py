@@ -3,12 +3,63 @@ Blur maker init
 """
 __version__ = "1.1.0"
 
-from .motion_blur import motion_blur
-from .lens_blur import lens_blur
-from .gaussian_blur import gaussian_blur
+import sys
+import importlib
+from types import ModuleType
 
-from .depth import motion_blur_with_depth_map
-from .depth import lens_blur_with_depth_map
-from .depth import gaussian_blur_with_depth_map
+# Public names and the submodule defining them. Submodules are imported on first
+# access, so importing the package does not load NumPy or OpenCV.
+lazy_attributes = {
+    'motion_blur': 'motion_blur',
+    'lens_blur': 'lens_blur',
+    'gaussian_blur': 'gaussian_blur',
 
-from .cli import main
+    'motion_blur_with_depth_map': 'depth',
+    'lens_blur_with_depth_map': 'depth',
+    'gaussian_blur_with_depth_map': 'depth',
+
+    'motion_blur_batch': 'batch',
+    'lens_blur_batch': 'batch',
+    'gaussian_blur_batch': 'batch',
+    'motion_blur_with_depth_map_batch': 'batch',
+    'lens_blur_with_depth_map_batch': 'batch',
+    'gaussian_blur_with_depth_map_batch': 'batch',
+
+    'motion_blur_async': 'aio',
+    'lens_blur_async': 'aio',
+    'gaussian_blur_async': 'aio',
+    'motion_blur_with_depth_map_async': 'aio',
+    'lens_blur_with_depth_map_async': 'aio',
+    'gaussian_blur_with_depth_map_async': 'aio',
+
+    'RefocusSession': 'refocus',
+
+    'main': 'cli',
+}
+
+__all__ = list(lazy_attributes)
+
+class LazyPackage(ModuleType):
+    '''Package module whose blur functions are not replaced by their submodules
+
+    Importing `blurgenerator.lens_blur` binds the submodule on the package, which
+    would hide the `lens_blur` function of the same name.
+    '''
+
+    def __setattr__(self, name, value):
+        if isinstance(value, ModuleType) and lazy_attributes.get(name) == name:
+            return
+        super().__setattr__(name, value)
+
+def __getattr__(name):
+    if name not in lazy_attributes:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module = importlib.import_module(f'{__name__}.{lazy_attributes[name]}')
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(lazy_attributes))
+
+sys.modules[__name__].__class__ = LazyPackage
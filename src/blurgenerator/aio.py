@@ -0,0 +1,64 @@
+"""
+Asyncio blur API
+"""
+import os
+import asyncio
+import functools
+import weakref
+
+from blurgenerator.motion_blur import motion_blur
+from blurgenerator.lens_blur import lens_blur
+from blurgenerator.gaussian_blur import gaussian_blur
+from blurgenerator.depth import motion_blur_with_depth_map, lens_blur_with_depth_map, gaussian_blur_with_depth_map
+
+state = {
+    'max_concurrency': os.cpu_count() or 1,
+    'executor': None,
+}
+
+# One semaphore per running event loop, since asyncio primitives are bound to a loop
+semaphores = weakref.WeakKeyDictionary()
+
+def configure(max_concurrency=None, executor=None):
+    '''Limit how many blurs run at once and, optionally, on which executor
+
+    Blurs run on the event loop's default executor unless `executor` is given. The
+    limit applies per event loop, and calls beyond it wait without holding a thread.
+    '''
+    if max_concurrency is not None:
+        if max_concurrency < 1:
+            raise ValueError('`max_concurrency` must be at least 1.')
+        state['max_concurrency'] = max_concurrency
+        semaphores.clear()
+    if executor is not None:
+        state['executor'] = executor
+
+def get_semaphore():
+    loop = asyncio.get_running_loop()
+    semaphore = semaphores.get(loop)
+    if semaphore is None:
+        semaphore = semaphores[loop] = asyncio.Semaphore(state['max_concurrency'])
+    return semaphore
+
+async def run_blocking(function, *args, **kwargs):
+    '''Run a blocking blur off the event loop once a concurrency slot is free'''
+    async with get_semaphore():
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(state['executor'], functools.partial(function, *args, **kwargs))
+
+def to_async(function):
+    '''Async counterpart of a blur function, limited by `configure`'''
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(function, *args, **kwargs)
+
+    wrapper.__name__ = wrapper.__qualname__ = f'{function.__name__}_async'
+    return wrapper
+
+motion_blur_async = to_async(motion_blur)
+lens_blur_async = to_async(lens_blur)
+gaussian_blur_async = to_async(gaussian_blur)
+
+motion_blur_with_depth_map_async = to_async(motion_blur_with_depth_map)
+lens_blur_with_depth_map_async = to_async(lens_blur_with_depth_map)
+gaussian_blur_with_depth_map_async = to_async(gaussian_blur_with_depth_map)
@@ -0,0 +1,143 @@
+"""
+Batch blur generator
+"""
+from random import randint
+
+import numpy as np
+
+from blurgenerator.motion_blur import get_motion_kernel, apply_motion_kernel
+from blurgenerator.lens_blur import lens_blur
+from blurgenerator.gaussian_blur import gaussian_blur
+from blurgenerator.depth import motion_blur_with_depth_map, lens_blur_with_depth_map, gaussian_blur_with_depth_map
+
+def store(result, dst):
+    '''Copy `result` into `dst` unless the job already wrote there'''
+    if result is not dst:
+        dst[...] = result
+
+def run_batch(job, images, depth_maps=None, out=None):
+    '''Run `job(frame, depth_map, dst)` for every frame
+
+    `images` is an (N,H,W,C) array or an iterable of frames. Results are written into
+    `out` when given. Without `out`, an array input gets an array of the same shape and
+    an iterable input gets a list of frames.
+    '''
+    if depth_maps is None:
+        frames = ((frame, None) for frame in images)
+    else:
+        frames = zip(images, depth_maps)
+
+    if isinstance(images, np.ndarray):
+        if images.ndim != 4:
+            raise ValueError('`images` must be an (N,H,W,C) array or an iterable of frames.')
+        if out is None:
+            out = np.empty_like(images)
+
+    if out is None:
+        return [job(frame, depth_map, None) for frame, depth_map in frames]
+
+    for idx, (frame, depth_map) in enumerate(frames):
+        if idx >= len(out):
+            raise ValueError('`out` holds fewer frames than `images`.')
+        dst = out[idx]
+        store(job(frame, depth_map, dst), dst)
+    return out
+
+def motion_blur_batch(images, size=None, angle=None, backend='auto', out=None):
+    '''Motion blur a stack of frames with one shared kernel
+
+    A random `size` and `angle` are drawn once for the whole batch when omitted.
+    '''
+    if size is None:
+        size = randint(20, 80)
+    if angle is None:
+        angle = randint(15, 30)
+
+    k = get_motion_kernel(size, angle)
+    return run_batch(
+        lambda frame, _, dst: apply_motion_kernel(frame, k, size, angle, backend=backend, dst=dst),
+        images,
+        out=out
+    )
+
+def lens_blur_batch(images, radius=3.0, components=5, exposure_gamma=5.0, backend='auto', executor=None, quality='exact', out=None):
+    '''Lens blur a stack of frames, reusing the cached kernels and the shared worker pool'''
+    return run_batch(
+        lambda frame, _, dst: lens_blur(
+            frame,
+            radius=radius,
+            components=components,
+            exposure_gamma=exposure_gamma,
+            backend=backend,
+            executor=executor,
+            dst=dst,
+            quality=quality
+        ),
+        images,
+        out=out
+    )
+
+def gaussian_blur_batch(images, kernel, sigma=5, method='auto', out=None):
+    '''Gaussian blur a stack of frames'''
+    return run_batch(
+        lambda frame, _, dst: gaussian_blur(frame, kernel, sigma=sigma, dst=dst, method=method),
+        images,
+        out=out
+    )
+
+def motion_blur_with_depth_map_batch(images, depth_maps, angle=30, num_layers=10, min_blur=1, max_blur=100, processes=None, out=None):
+    '''Motion blur a stack of frames with their paired depth maps'''
+    return run_batch(
+        lambda frame, depth_map, dst: motion_blur_with_depth_map(
+            frame,
+            depth_map,
+            angle=angle,
+            num_layers=num_layers,
+            min_blur=min_blur,
+            max_blur=max_blur,
+            dst=dst,
+            processes=processes
+        ),
+        images,
+        depth_maps=depth_maps,
+        out=out
+    )
+
+def lens_blur_with_depth_map_batch(images, depth_maps, components=5, exposure_gamma=5, num_layers=10, min_blur=1, max_blur=100, executor=None, processes=None, quality='exact', out=None):
+    '''Lens blur a stack of frames with their paired depth maps, reusing the shared worker pool'''
+    return run_batch(
+        lambda frame, depth_map, dst: lens_blur_with_depth_map(
+            frame,
+            depth_map,
+            components=components,
+            exposure_gamma=exposure_gamma,
+            num_layers=num_layers,
+            min_blur=min_blur,
+            max_blur=max_blur,
+            executor=executor,
+            dst=dst,
+            processes=processes,
+            quality=quality
+        ),
+        images,
+        depth_maps=depth_maps,
+        out=out
+    )
+
+def gaussian_blur_with_depth_map_batch(images, depth_maps, sigma=5, num_layers=10, min_blur=1, max_blur=100, processes=None, out=None):
+    '''Gaussian blur a stack of frames with their paired depth maps'''
+    return run_batch(
+        lambda frame, depth_map, dst: gaussian_blur_with_depth_map(
+            frame,
+            depth_map,
+            sigma=sigma,
+            num_layers=num_layers,
+            min_blur=min_blur,
+            max_blur=max_blur,
+            dst=dst,
+            processes=processes
+        ),
+        images,
+        depth_maps=depth_maps,
+        out=out
+    )
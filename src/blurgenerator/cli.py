@@ -1,17 +1,106 @@
 """
 Blur Maker
 """
+import os
+import sys
 import argparse
 from pathlib import Path
 
-import cv2
-import numpy as np
+# OpenCV and the blur modules are imported once the arguments are parsed, so that
+# `--help` and argument errors return without loading them.
 
-from blurgenerator import motion_blur, lens_blur, gaussian_blur
+def build_jobs(args):
+    '''Build the `(blur_job, depth_job)` pair for the parsed command line'''
+    from blurgenerator import motion_blur, lens_blur, gaussian_blur
+    from blurgenerator import motion_blur_with_depth_map, lens_blur_with_depth_map, gaussian_blur_with_depth_map
+
+    if args.type == 'motion':
+        def blur_job(img):
+            return motion_blur(img, size=args.motion_blur_size, angle=args.motion_blur_angle)
+        def depth_job(img, depth_map):
+            return motion_blur_with_depth_map(img, depth_map, angle=args.motion_blur_angle, num_layers=args.depth_num_layers, min_blur=args.depth_min_blur, max_blur=args.depth_max_blur, continuous=args.depth_continuous, num_levels=args.depth_num_levels, processes=args.depth_processes)
+
+    if args.type == 'lens':
+        def blur_job(img):
+            return lens_blur(img, radius=args.lens_radius, components=args.lens_components, exposure_gamma=args.lens_exposure_gamma, quality=args.lens_quality)
+        def depth_job(img, depth_map):
+            return lens_blur_with_depth_map(img, depth_map, components=args.lens_components, exposure_gamma=args.lens_exposure_gamma, num_layers=args.depth_num_layers, min_blur=args.depth_min_blur, max_blur=args.depth_max_blur, continuous=args.depth_continuous, num_levels=args.depth_num_levels, processes=args.depth_processes, quality=args.lens_quality)
+
+    if args.type == 'gaussian':
+        def blur_job(img):
+            return gaussian_blur(img, args.gaussian_kernel)
+        def depth_job(img, depth_map):
+            return gaussian_blur_with_depth_map(img, depth_map, num_layers=args.depth_num_layers, min_blur=args.depth_min_blur, max_blur=args.depth_max_blur, continuous=args.depth_continuous, num_levels=args.depth_num_levels, processes=args.depth_processes)
+
+    if args.cache_dir:
+        from blurgenerator.result_cache import ResultCache
+        cache = ResultCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 2**20))
+        # Every option of the selected blur is part of the key; `depth_processes` does not change the result
+        options = vars(args)
+        blur_params = {name: value for name, value in options.items() if name.startswith(args.type)}
+        depth_params = dict(blur_params, **{name: value for name, value in options.items() if name.startswith('depth_') and name != 'depth_processes'})
+        blur_job = cache.wrap(blur_job, f'cli.{args.type}', blur_params)
+        depth_job = cache.wrap(depth_job, f'cli.{args.type}_with_depth_map', depth_params)
+
+    return blur_job, depth_job
+
+def report_cache(job):
+    if hasattr(job, 'cache'):
+        info = job.cache.info()
+        print(f'----- Cache: {info.hits} hits, {info.misses} misses, {info.currsize / 2**20:.1f} MiB stored.')
+
+def check_type(args):
+    if args.type not in ['motion', 'lens', 'gaussian']:
+        print('----- No type has been selected. Please specific `motion`, `lens`, or `gaussian`.')
+        return False
+    return True
+
+def run_input_dir(args):
+    '''Blur every image of `input_dir` into `output_dir` on a process pool'''
+    from blurgenerator.directory import find_tasks, run_directory
+
+    input_dir = Path(args.input_dir)
+    if not input_dir.is_dir():
+        print('----- `input_dir` is not a directory!')
+        return
+    if not args.output_dir:
+        print('----- Please specific `output_dir` for `input_dir`.')
+        return
+    if not check_type(args):
+        return
+
+    depth_dir = args.input_depth_map
+    if depth_dir is not None and not Path(depth_dir).is_dir():
+        print('----- `input_depth_map` must be a directory when `input_dir` is used.')
+        return
+
+    tasks, skipped = find_tasks(input_dir, args.output_dir, args.glob, depth_dir=depth_dir, skip_up_to_date=not args.force)
+    workers = args.workers or os.cpu_count() or 1
+    print(f'----- Generating `{args.type}` blur for {len(tasks)} images with {workers} workers.')
+    summary = run_directory(tasks, build_jobs, args, workers=workers, max_in_flight=args.max_in_flight)
+    summary.skipped += skipped
+    print(summary.report())
+
+def serve_main(argv):
+    '''Run the local micro-batching blur service'''
+    parser = argparse.ArgumentParser(prog='blurgenerator serve')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to bind. Default is `127.0.0.1`.')
+    parser.add_argument('--port', type=int, default=8000, help='Port to bind. Default is 8000.')
+    parser.add_argument('--max_batch', '--max-batch', type=int, default=8, help='Requests with identical parameters blurred in one batch. Default is 8.')
+    parser.add_argument('--max_delay_ms', '--max-delay-ms', type=float, default=5.0, help='Milliseconds a request waits for batch mates. Default is 5.')
+    parser.add_argument('--workers', type=int, default=1, help='Batches blurred concurrently. Default is 1.')
+    args = parser.parse_args(argv)
+
+    from blurgenerator.serve import serve
+    serve(host=args.host, port=args.port, max_batch=args.max_batch, max_delay=args.max_delay_ms / 1000, workers=args.workers)
 
 def main():
 
-    parser = argparse.ArgumentParser()
+    if sys.argv[1:2] == ['serve']:
+        serve_main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(epilog='Run `blurgenerator serve --help` for the local HTTP service.')
 
     parser.add_argument('--input', type=str, default=None, help='Specific path of image as `input`.')
     parser.add_argument('--input_depth_map', type=str, default=None, help='Specific path of depth image as `input_depth_map`.')
@@ -26,6 +115,7 @@ def main():
     parser.add_argument('--lens_radius', type=float, default=5.0, help='Radius for lens blur. Default is 5.0.')
     parser.add_argument('--lens_components', type=int, default=4, help='Components for lens blur. Default is 4.')
     parser.add_argument('--lens_exposure_gamma', type=int, default=2, help='Exposure gamma for lens blur. Default is 2.')
+    parser.add_argument('--lens_quality', type=str, default='exact', choices=['exact', 'fast'], help='`fast` blurs large radii on a reduced image. Default is `exact`.')
 
     parser.add_argument('--gaussian_kernel', type=int, default=100, help='Kernel for gaussian. Default is 100.')
 
@@ -33,100 +123,130 @@ def main():
     parser.add_argument('--depth_num_layers', type=int, default=10, help='Layer for depth blur. Default is 3.')
     parser.add_argument('--depth_min_blur', type=int, default=1, help='Min. blur for depth blur. Default is 1.')
     parser.add_argument('--depth_max_blur', type=int, default=100, help='Max. blur for depth blur. Default is 100.')
+    parser.add_argument('--depth_continuous', action='store_true', help='Interpolate a fixed stack of blurs per pixel instead of hard depth layers.')
+    parser.add_argument('--depth_num_levels', type=int, default=5, help='Blurs in the stack of continuous depth blur. Default is 5.')
+    parser.add_argument('--depth_processes', type=int, default=None, help='Processes blurring the depth layers of one image in parallel through shared memory. Default is none.')
+
+    # directory batch settings
+    parser.add_argument('--input_dir', '--input-dir', type=str, default=None, help='Specific directory of images to blur in one process pool.')
+    parser.add_argument('--output_dir', '--output-dir', type=str, default=None, help='Specific directory for the outputs of `input_dir`.')
+    parser.add_argument('--glob', type=str, default='*', help='Pattern of files to pick from `input_dir`, e.g. `**/*.jpg`. Default is `*`.')
+    parser.add_argument('--max_in_flight', '--max-in-flight', type=int, default=None, help='Images submitted to the pool at a time. Default is twice `workers`.')
+    parser.add_argument('--force', action='store_true', help='Process images even if their outputs are up to date.')
+
+    # streaming settings
+    parser.add_argument('--workers', type=int, default=None, help='Number of parallel blur workers. Default is 1 for video input and the CPU count for `input_dir`.')
+    parser.add_argument('--prefetch', type=int, default=8, help='Frames buffered between decode, blur and encode for video input. Default is 8.')
+    parser.add_argument('--fps', type=float, default=30.0, help='Frame rate of the output when `input` is a directory of frames. Default is 30.')
+
+    # result cache settings
+    parser.add_argument('--cache_dir', '--cache-dir', type=str, default=None, help='Directory caching results by input pixels and parameters, so reruns skip the blur. Default is none.')
+    parser.add_argument('--cache_max_mb', '--cache-max-mb', type=float, default=1024, help='Size cap of `cache_dir` in MiB; least recently used results are deleted beyond it. Default is 1024.')
+
+    # profiling settings
+    parser.add_argument('--profile', action='store_true', help='Print the time, calls and allocations of every blur stage and depth layer. Directories are profiled with `--workers 1` only.')
 
     # ---------------------------------------------------------------
 
     args = parser.parse_args()
 
+    if not args.profile:
+        run(args)
+        return
+
+    from blurgenerator.profiling import profile
+    with profile() as stats:
+        run(args)
+    print(stats.report())
+
+def run(args):
+    '''Blur the inputs of the parsed command line'''
+    import cv2
+    from blurgenerator.stream import blur_stream, is_stream, is_video
+
+    if args.input_dir:
+        run_input_dir(args)
+        return
+
     if not args.input:
         print('----- Please specific image for input.')
         return
 
     img_path = Path(args.input)
+    if not img_path.exists():
+        print('----- `img_path` does not exist!')
+        return
+    streaming = is_stream(img_path)
 
-    if not img_path.is_file():
+    if not img_path.is_file() and not streaming:
         print('----- `img_path` is not a file!')
         return
 
-    if img_path.suffix not in ['.jpg', '.jpeg', '.png']:
-        print('----- Only support common types of image `.jpg` and `.png`.')
+    if img_path.suffix not in ['.jpg', '.jpeg', '.png'] and not streaming:
+        print('----- Only support common types of image `.jpg` and `.png`, videos or directories of frames.')
         return
 
-    if args.type not in ['motion', 'lens', 'gaussian']:
-        print('----- No type has been selected. Please specific `motion`, `lens`, or `gaussian`.')
+    if not check_type(args):
         return
 
-    if args.type == 'motion':
-        def blur_job(img, size=args.motion_blur_size):
-            return motion_blur(img, size=size, angle=args.motion_blur_angle)
+    blur_job, depth_job = build_jobs(args)
 
-    if args.type == 'lens':
-        def blur_job(img, radius=args.lens_radius):
-            return lens_blur(img, radius=radius, components=args.lens_components, exposure_gamma=args.lens_exposure_gamma)
+    # ---------------------------------------------------------------
 
-    if args.type == 'gaussian':
-        def blur_job(img, kernel=args.gaussian_kernel):
-            return gaussian_blur(img, kernel)
+    depth_map_path = args.input_depth_map
 
-    # ---------------------------------------------------------------
+    if depth_map_path is not None:
+        depth_map_path = Path(depth_map_path)
+        if not depth_map_path.exists():
+            print('----- `input_depth_map` does not exist!')
+            return
+        if streaming != is_stream(depth_map_path):
+            print('----- `input` and `input_depth_map` must both be images or both be streams.')
+            return
+        if not streaming and not depth_map_path.is_file():
+            print('----- `input_depth_map` is not a file!')
+            return
+        if not streaming and depth_map_path.suffix not in ['.jpg', '.jpeg', '.png']:
+            print('----- Only support common types of image `.jpg` and `.png`.')
+            return
+
+        print(f'----- Generating `{args.type}` blur with depth map.')
+        print('----- `motion_blur_size` will be ignored.')
+        print('----- `lens_radius` will be ignored.')
+        print('----- `gaussian_kernel` will be ignored.')
+    else:
+        print(f'----- Generating `{args.type}` blur.')
 
-    img = cv2.imread(img_path.absolute().as_posix())
+    if streaming:
+        output = args.output
+        if not is_video(output):
+            output = Path(output).with_suffix('.mp4').as_posix()
+        frames, seconds = blur_stream(
+            img_path,
+            output,
+            blur_job if depth_map_path is None else depth_job,
+            depth_src=depth_map_path,
+            fps=args.fps,
+            prefetch=args.prefetch,
+            workers=args.workers or 1
+        )
+        fps = frames / seconds if seconds > 0 else 0.0
+        print(f'----- Wrote {frames} frames to `{output}` in {seconds:.2f}s ({fps:.2f} frames/s).')
+        report_cache(blur_job)
+        return
 
-    depth_map_path = args.input_depth_map
+    img = cv2.imread(img_path.absolute().as_posix())
 
     if depth_map_path is None:
-        print(f'----- Generating `{args.type}` blur.')
         result = blur_job(img)
         cv2.imwrite(args.output, result)
+        report_cache(blur_job)
         return
 
-    depth_map_path = Path(depth_map_path)
-    if not depth_map_path.is_file():
-        print('----- `input_depth_map` is not a file!')
-        return
-    if depth_map_path.suffix not in ['.jpg', '.jpeg', '.png']:
-        print('----- Only support common types of image `.jpg` and `.png`.')
-        return
-
-    print(f'----- Generating `{args.type}` blur with depth map.')
-    print('----- `motion_blur_size` will be ignored.')
-    print('----- `lens_radius` will be ignored.')
-    print('----- `gaussian_kernel` will be ignored.')
-
     depth_map = cv2.imread(depth_map_path.absolute().as_posix())
 
-    def map_range(value, inMin, inMax, outMin, outMax):
-        return outMin + (((value - inMin) / (inMax - inMin)) * (outMax - outMin))
-
-    def blur_with_depth(img, depth, num_layers=10, min_blur=1, max_blur=100):
-        min_depth = np.min(np.unique(depth))
-        max_depth = np.max(np.unique(depth))
-        step = (max_depth - min_depth) // num_layers
-        layers = np.array(range(min_depth, max_depth, step))
-        out = np.zeros(img.shape)
-
-        for value in layers:
-            dm = cv2.cvtColor(depth, cv2.COLOR_BGR2GRAY)
-            m = np.zeros(dm.shape)
-            m[dm > value] = 255
-            m[dm > (value + step)] = 0
-            l_mask = depth.copy()
-            l_mask[:,:,0] = m[:,:]
-            l_mask[:,:,1] = m[:,:]
-            l_mask[:,:,2] = m[:,:]
-            blur_amount = int(map_range(value, 0, 255, min_blur, max_blur))
-            slice = blur_job(img, blur_amount)
-            _, mask = cv2.threshold(l_mask, 100, 255, cv2.THRESH_BINARY)
-            layer = cv2.bitwise_and(slice, slice, mask = mask[:,:,0])
-            out = cv2.add(out, layer, dtype=0)
-        return out
-
-    num_layers = args.depth_num_layers
-    min_blur = args.depth_min_blur
-    max_blur = args.depth_max_blur
-
-    result = blur_with_depth(img, depth_map, num_layers=num_layers, min_blur=min_blur, max_blur=max_blur)
+    result = depth_job(img, depth_map)
     cv2.imwrite(args.output, result)
+    report_cache(depth_job)
 
     return
-
@@ -0,0 +1,126 @@
+"""
+Convolution backends
+"""
+from typing import Tuple, Hashable, Optional
+
+import cv2
+import numpy as np
+
+from blurgenerator.kernel_cache import KernelCache
+
+BACKENDS = ('spatial', 'fft', 'auto')
+
+# Crossover between the spatial and the FFT backend as (minimum kernel size, minimum image area).
+# The FFT cost is almost flat in the kernel size while the spatial cost grows with it. Lens
+# figures were measured on 64x64 to 4K frames. Motion figures were timed single-threaded from
+# 64x64 to 1920x1080 with both backends in double precision, as 8-bit motion blurs are: the
+# FFT only wins from about 81 px on frames of 640x480 and more.
+fft_crossover = {
+    'lens': (11, 64 * 64),
+    'motion': (81, 640 * 480),
+}
+
+# Kernel spectra keyed by the caller's kernel key and the transform size. Each spectrum
+# is as large as the padded frame, and depth layers and tiles each have their own shape,
+# so the cache is capped in bytes: about two float32 spectra of a 4K frame.
+spectrum_cache = KernelCache(maxsize=64 * 2**20, weigh=lambda spectrum: spectrum.nbytes)
+
+def check_backend(backend: str):
+    """
+    Raise a `ValueError` for unknown backends.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend `{backend}`. Please use one of {", ".join(BACKENDS)}.')
+
+def choose_backend(backend: str, kind: str, kernel_size: int, area: int) -> str:
+    """
+    Resolve `auto` to `spatial` or `fft` for a kernel of `kernel_size` pixels across and an image of `area` pixels.
+    """
+    check_backend(backend)
+    if backend != 'auto':
+        return backend
+    min_kernel_size, min_area = fft_crossover[kind]
+    if kernel_size >= min_kernel_size and area >= min_area:
+        return 'fft'
+    return 'spatial'
+
+def fft_shape(image_shape: Tuple[int, int], kernel_shape: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Transform size that holds the padded image without wrap-around in the valid region.
+    """
+    return (
+        cv2.getOptimalDFTSize(image_shape[0] + kernel_shape[0] - 1),
+        cv2.getOptimalDFTSize(image_shape[1] + kernel_shape[1] - 1),
+    )
+
+def work_dtype(dtype: np.dtype) -> np.dtype:
+    """
+    Floating point type a plane of `dtype` is transformed in: `float32` planes stay in
+    single precision, everything else is transformed in double precision, so that the
+    rounding of integer images does not depend on the transform size.
+    """
+    return np.dtype(np.float32) if dtype == np.float32 else np.dtype(np.float64)
+
+def kernel_spectrum(kernel: np.ndarray, shape: Tuple[int, int], key: Optional[Hashable] = None,
+                    dtype: np.dtype = np.float32) -> np.ndarray:
+    """
+    Packed `cv2.dft` spectrum of the flipped kernel, so that multiplying by it performs a
+    correlation like `cv2.filter2D`. Spectra are cached when a `key` identifying the kernel is given.
+    """
+    def build():
+        padded = np.zeros(shape, dtype=dtype)
+        padded[:kernel.shape[0], :kernel.shape[1]] = kernel[::-1, ::-1]
+        spectrum = cv2.dft(padded)
+        spectrum.setflags(write=False)
+        return spectrum
+
+    if key is None:
+        return build()
+    return spectrum_cache.get((key, shape, np.dtype(dtype).str), build)
+
+def fft_filter2d(plane: np.ndarray, kernel: np.ndarray, border_type: int = cv2.BORDER_REFLECT_101,
+                 key: Optional[Hashable] = None, dst: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Equivalent of `cv2.filter2D(plane, -1, kernel, borderType=border_type)` on a single channel, computed by FFT.
+
+    The transforms run in the precision of `work_dtype`, so `float32` planes are never
+    widened to double precision.
+    """
+    height, width = plane.shape
+    kernel_height, kernel_width = kernel.shape
+    anchor_y, anchor_x = kernel_height // 2, kernel_width // 2
+    dtype = work_dtype(plane.dtype)
+    shape = fft_shape(plane.shape, kernel.shape)
+    # Border padding of the plane followed by zeros up to the transform size
+    padded = np.zeros(shape, dtype=dtype)
+    padded[:height + kernel_height - 1, :width + kernel_width - 1] = cv2.copyMakeBorder(
+        plane.astype(dtype, copy=False),
+        anchor_y, kernel_height - 1 - anchor_y, anchor_x, kernel_width - 1 - anchor_x,
+        border_type
+    )
+    spectrum = cv2.dft(padded)
+    cv2.mulSpectrums(spectrum, kernel_spectrum(kernel, shape, key, dtype), 0, c=spectrum)
+    full = cv2.idft(spectrum, flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT)
+    valid = full[kernel_height - 1:kernel_height - 1 + height, kernel_width - 1:kernel_width - 1 + width]
+    if np.issubdtype(plane.dtype, np.integer):
+        # Round and saturate like OpenCV does for integer images. Exact halves are common
+        # with box-like kernels, so the transform noise is snapped away before rounding
+        # to keep them from rounding differently on differently sized regions.
+        limits = np.iinfo(plane.dtype)
+        valid = np.clip(np.rint(np.round(valid, 6)), limits.min, limits.max)
+    if dst is None:
+        return valid.astype(plane.dtype)
+    dst[...] = valid
+    return dst
+
+def fft_filter_image(img: np.ndarray, kernel: np.ndarray, border_type: int = cv2.BORDER_REFLECT_101,
+                     key: Optional[Hashable] = None) -> np.ndarray:
+    """
+    Apply `fft_filter2d` to every channel of an HxW or HxWxC image.
+    """
+    if img.ndim == 2:
+        return fft_filter2d(img, kernel, border_type, key=key)
+    output = np.empty_like(img)
+    for channel in range(img.shape[2]):
+        fft_filter2d(img[:, :, channel], kernel, border_type, key=key, dst=output[:, :, channel])
+    return output
@@ -1,15 +1,25 @@
+import time
+from functools import partial
+from concurrent.futures import Executor
+
 import numpy as np
 import cv2
 
 from blurgenerator import motion_blur, lens_blur, gaussian_blur
+from blurgenerator.lens_blur import get_halo
+from blurgenerator.profiling import stage, record_layer, enabled
 
 def map_range(value, inMin, inMax, outMin, outMax):
     return outMin + (((value - inMin) / (inMax - inMin)) * (outMax - outMin))
 
+# Label of pixels which do not belong to any depth layer
+NO_LAYER = 255
+
 def get_depth_step_and_layer(depth_map, num_layers):
-    min_depth = np.min(np.unique(depth_map))
-    max_depth = np.max(np.unique(depth_map))
-    step = (max_depth - min_depth) // num_layers
+    min_depth = int(depth_map.min())
+    max_depth = int(depth_map.max())
+    # At least one depth value per layer, when the range is narrower than `num_layers`
+    step = max(1, (max_depth - min_depth) // num_layers)
     layers = np.array(range(min_depth, max_depth, step))
     return step, layers
 
@@ -39,62 +49,251 @@ def blur_with_depth(depth_map, num_layers=10, min_blur=1, max_blur=100):
         blur_masks.append((blur_amount, l_mask))
     return blur_masks
 
-def motion_blur_with_depth_map(img, depth_map, angle=30, num_layers=10, min_blur=1, max_blur=100):
-    out = np.zeros(img.shape)
-    blur_masks = blur_with_depth(
-        depth_map,
-        num_layers=num_layers,
-        min_blur=min_blur,
-        max_blur=max_blur
-    )
-    for blur_amount, l_mask in blur_masks:
-        slice = motion_blur(
-            img,
-            size=blur_amount,
-            angle=angle
-        )
-        _, mask = cv2.threshold(l_mask, 100, 255, cv2.THRESH_BINARY)
-        layer = cv2.bitwise_and(slice, slice, mask=mask[:,:,0])
-        out = cv2.add(out, layer, dtype=0)
+def to_gray(depth_map):
+    """
+    Single channel view of a depth map, converting BGR maps only once.
+    """
+    if depth_map.ndim == 2:
+        return depth_map
+    return cv2.cvtColor(depth_map, cv2.COLOR_BGR2GRAY)
+
+def label_depth_map(depth_map, num_layers=10, min_blur=1, max_blur=100):
+    """
+    Quantise a depth map into a uint8 label image in a single pass.
+
+    Pixel `(y, x)` is labelled with the index into the returned `blur_amounts` of the layer
+    it belongs to, or `NO_LAYER`. Layers mapping to the same blur amount share one label.
+    """
+    step, layers = get_depth_step_and_layer(depth_map, num_layers)
+    if len(layers) == 0:
+        # A flat depth map leaves every pixel out of the layers
+        return np.full(to_gray(depth_map).shape, NO_LAYER, dtype=np.uint8), []
+
+    blur_amounts = []
+    layer_labels = []
+    for value in layers:
+        blur_amount = int(map_range(value, 0, 255, min_blur, max_blur))
+        if blur_amount not in blur_amounts:
+            blur_amounts.append(blur_amount)
+        layer_labels.append(blur_amounts.index(blur_amount))
+
+    # A pixel belongs to the layer starting at `value` when value < depth <= value + step
+    edges = np.append(layers, layers[-1] + step)
+    bins = np.digitize(np.arange(256), edges, right=True)
+    lut = np.full(256, NO_LAYER, dtype=np.uint8)
+    inside = (bins >= 1) & (bins <= len(layers))
+    lut[inside] = np.asarray(layer_labels, dtype=np.uint8)[bins[inside] - 1]
+
+    labels = cv2.LUT(to_gray(depth_map), lut)
+    return labels, blur_amounts
+
+def iter_layer_masks(labels, count):
+    """
+    Yield `(label, mask)` for each label, reusing one boolean buffer for every mask.
+    A mask is only valid until the next one is requested.
+    """
+    mask = np.empty(labels.shape, dtype=bool)
+    for label in range(count):
+        with stage('depth.masks'):
+            np.equal(labels, label, out=mask)
+        yield label, mask
+
+def layer_bounds(mask, halo, shape):
+    """
+    Bounding box of a layer mask and the same box grown by `halo` pixels, clipped to `shape`.
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None, None
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1 = rows[0], rows[-1] + 1
+    x0, x1 = cols[0], cols[-1] + 1
+    height, width = shape[:2]
+    padded = (max(0, y0 - halo), min(height, y1 + halo), max(0, x0 - halo), min(width, x1 + halo))
+    return (y0, y1, x0, x1), padded
+
+def composite_layers(img, labels, blur_amounts, blur_job, halo_job, out=None):
+    """
+    Blur every depth layer once and composite it in place into a single output.
+
+    Each blur only runs over the bounding box its layer touches plus a halo of
+    `halo_job(blur_amount)` pixels, which is enough for the pixels inside the box
+    to match a full-frame blur. The result is written into `out` when given.
+    """
+    if out is None:
+        out = np.zeros_like(img)
+    else:
+        out[...] = 0
+
+    for label, mask in iter_layer_masks(labels, len(blur_amounts)):
+        blur_amount = blur_amounts[label]
+        with stage('depth.masks'):
+            box, padded = layer_bounds(mask, halo_job(blur_amount), img.shape)
+        if box is None:
+            continue
+        y0, y1, x0, x1 = box
+        py0, py1, px0, px1 = padded
+        start = time.perf_counter()
+        with stage('depth.blur'):
+            slice = blur_job(img[py0:py1, px0:px1], blur_amount)
+        if enabled():
+            record_layer('layer', blur_amount, (py1 - py0) * (px1 - px0), time.perf_counter() - start)
+        with stage('depth.composite'):
+            region_mask = mask[y0:y1, x0:x1]
+            region = slice[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+            out[y0:y1, x0:x1][region_mask] = region[region_mask]
     return out
 
-def lens_blur_with_depth_map(img, depth_map, components=5, exposure_gamma=5, num_layers=10, min_blur=1, max_blur=100):
-    out = np.zeros(img.shape)
-    blur_masks = blur_with_depth(
-        depth_map,
-        num_layers=num_layers,
-        min_blur=min_blur,
-        max_blur=max_blur
-    )
+def composite_layers_shared(img, labels, blur_amounts, blur_job, halo_job, out=None, processes=None):
+    """
+    `composite_layers` on a process pool, one task per depth layer.
 
-    for blur_amount, l_mask in blur_masks:
-        slice = lens_blur(
-            img,
-            radius=blur_amount,
-            components=components,
-            exposure_gamma=exposure_gamma
-        )
-        _, mask = cv2.threshold(l_mask, 100, 255, cv2.THRESH_BINARY)
-        layer = cv2.bitwise_and(slice, slice, mask=mask[:,:,0])
-        out = cv2.add(out, layer, dtype=0)
+    The image, the labels and the output live in shared memory, so workers read and
+    write pixels without copying them, and composite straight into the output.
+    `blur_job` must be picklable. `processes` is a worker count for the module-level
+    pool of `blurgenerator.processes` or a caller-owned `ProcessPoolExecutor`.
+    """
+    from blurgenerator.processes import SharedArray, get_process_pool, blur_shared_layer
+
+    executor = processes if isinstance(processes, Executor) else get_process_pool(processes)
+    layers = []
+    for label, mask in iter_layer_masks(labels, len(blur_amounts)):
+        blur_amount = blur_amounts[label]
+        with stage('depth.masks'):
+            box, padded = layer_bounds(mask, halo_job(blur_amount), img.shape)
+        if box is not None:
+            layers.append((label, blur_amount, box, padded))
+    # Largest layers first, so the last tasks to finish are short ones
+    layers.sort(key=lambda layer: -(layer[3][1] - layer[3][0]) * (layer[3][3] - layer[3][2]))
+
+    with stage('depth.shared_blur'), SharedArray.copy_of(img) as shared_img, SharedArray.copy_of(labels) as shared_labels, SharedArray(img.shape, img.dtype) as shared_out:
+        shared_out.array[...] = 0
+        futures = [
+            executor.submit(blur_shared_layer, blur_job, shared_img.descriptor(), shared_labels.descriptor(), shared_out.descriptor(), label, blur_amount, box, padded)
+            for label, blur_amount, box, padded in layers
+        ]
+        for future in futures:
+            future.result()
+        if out is None:
+            out = np.empty_like(img)
+        out[...] = shared_out.array
+    return out
+
+def get_blur_levels(min_blur, max_blur, num_levels):
+    """
+    Distinct integer blur amounts spread evenly between `min_blur` and `max_blur`.
+    """
+    levels = np.round(np.linspace(min_blur, max_blur, max(1, num_levels))).astype(int)
+    return [int(level) for level in np.unique(levels)]
+
+def interpolate_blur_stack(img, depth_map, blur_job, num_levels=5, min_blur=1, max_blur=100, out=None):
+    """
+    Continuous depth of field from a fixed stack of blurs.
+
+    The image is blurred once per level of `get_blur_levels`, and every pixel blends
+    the two levels nearest to the blur amount its depth maps to, linearly. The number
+    of blurs therefore stays at `num_levels` whatever the depth resolution.
+    """
+    levels = get_blur_levels(min_blur, max_blur, num_levels)
+    # Fractional position of every depth value in the stack
+    blur_amounts = map_range(np.arange(256, dtype=np.float64), 0, 255, min_blur, max_blur)
+    positions = np.interp(blur_amounts, levels, np.arange(len(levels)))
+
+    gray = to_gray(depth_map)
+    accumulated = np.zeros(img.shape, dtype=np.float32)
+    for level, blur_amount in enumerate(levels):
+        # Hat-shaped weight, so each pixel takes (1 - t) and t from its two nearest levels
+        weights = np.clip(1 - np.abs(positions - level), 0, 1).astype(np.float32)
+        if not weights.any():
+            continue
+        start = time.perf_counter()
+        with stage('depth.blur'):
+            blurred = blur_job(img, blur_amount)
+        if enabled():
+            record_layer('level', blur_amount, img.shape[0] * img.shape[1], time.perf_counter() - start)
+        with stage('depth.composite'):
+            weight_map = cv2.LUT(gray, weights)
+            if img.ndim == 3:
+                weight_map = weight_map[:, :, None]
+            accumulated += blurred * weight_map
+
+    with stage('depth.composite'):
+        if out is None:
+            out = np.empty_like(img)
+        np.rint(accumulated, out=accumulated)
+        np.copyto(out, np.clip(accumulated, 0, 255), casting='unsafe')
     return out
 
-def gaussian_blur_with_depth_map(img, depth_map, sigma=5, num_layers=10, min_blur=1, max_blur=100):
-    out = np.zeros(img.shape)
-    blur_masks = blur_with_depth(
+def blur_with_depth_map(img, depth_map, blur_job, halo_job, num_layers, min_blur, max_blur, continuous, num_levels, dst, processes=None):
+    """
+    Dispatch a depth blur to the layered or the continuous engine, running layers on
+    a process pool when `processes` is given.
+    """
+    if continuous:
+        return interpolate_blur_stack(img, depth_map, blur_job, num_levels=num_levels, min_blur=min_blur, max_blur=max_blur, out=dst)
+    with stage('depth.labels') as timer:
+        labels, blur_amounts = label_depth_map(
+            depth_map,
+            num_layers=num_layers,
+            min_blur=min_blur,
+            max_blur=max_blur
+        )
+        timer.add_bytes(labels.nbytes)
+    if processes:
+        return composite_layers_shared(img, labels, blur_amounts, blur_job, halo_job, out=dst, processes=processes)
+    return composite_layers(img, labels, blur_amounts, blur_job, halo_job, out=dst)
+
+# Layer blurs are top-level functions, so that they can be pickled for a process pool
+def motion_layer(region, blur_amount, angle=30):
+    return motion_blur(region, size=blur_amount, angle=angle)
+
+def lens_layer(region, blur_amount, components=5, exposure_gamma=5, executor=None, quality='exact'):
+    return lens_blur(region, radius=blur_amount, components=components, exposure_gamma=exposure_gamma, executor=executor, quality=quality)
+
+def gaussian_layer(region, blur_amount, sigma=5):
+    return gaussian_blur(region, blur_amount, sigma=sigma)
+
+def motion_blur_with_depth_map(img, depth_map, angle=30, num_layers=10, min_blur=1, max_blur=100, dst=None, continuous=False, num_levels=5, processes=None):
+    return blur_with_depth_map(
+        img,
         depth_map,
-        num_layers=num_layers,
-        min_blur=min_blur,
-        max_blur=max_blur
+        partial(motion_layer, angle=angle),
+        lambda blur_amount: blur_amount,
+        num_layers,
+        min_blur,
+        max_blur,
+        continuous,
+        num_levels,
+        dst,
+        processes
     )
 
-    for blur_amount, l_mask in blur_masks:
-        slice = gaussian_blur(
-            img,
-            blur_amount,
-            sigma=sigma
-        )
-        _, mask = cv2.threshold(l_mask, 100, 255, cv2.THRESH_BINARY)
-        layer = cv2.bitwise_and(slice, slice, mask=mask[:,:,0])
-        out = cv2.add(out, layer, dtype=0)
-    return out
\ No newline at end of file
+def lens_blur_with_depth_map(img, depth_map, components=5, exposure_gamma=5, num_layers=10, min_blur=1, max_blur=100, executor=None, dst=None, continuous=False, num_levels=5, processes=None, quality='exact'):
+    return blur_with_depth_map(
+        img,
+        depth_map,
+        partial(lens_layer, components=components, exposure_gamma=exposure_gamma, executor=None if processes else executor, quality=quality),
+        partial(get_halo, quality=quality),
+        num_layers,
+        min_blur,
+        max_blur,
+        continuous,
+        num_levels,
+        dst,
+        processes
+    )
+
+def gaussian_blur_with_depth_map(img, depth_map, sigma=5, num_layers=10, min_blur=1, max_blur=100, dst=None, continuous=False, num_levels=5, processes=None):
+    return blur_with_depth_map(
+        img,
+        depth_map,
+        partial(gaussian_layer, sigma=sigma),
+        lambda blur_amount: blur_amount // 2 + 1,
+        num_layers,
+        min_blur,
+        max_blur,
+        continuous,
+        num_levels,
+        dst,
+        processes
+    )
@@ -0,0 +1,152 @@
+"""
+Directory batch processing
+"""
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+
+from blurgenerator.pool import configure
+
+image_suffixes = ['.jpg', '.jpeg', '.png']
+
+class Summary:
+    '''Counts and per-stage seconds of a directory run'''
+
+    def __init__(self):
+        self.images = 0
+        self.skipped = 0
+        self.failed = []
+        self.seconds = 0.0
+        self.stages = {'decode': 0.0, 'blur': 0.0, 'encode': 0.0}
+
+    def add(self, timings):
+        self.images += 1
+        for stage, seconds in timings.items():
+            self.stages[stage] += seconds
+
+    def report(self):
+        rate = self.images / self.seconds if self.seconds > 0 else 0.0
+        lines = [
+            f'----- Processed {self.images} images in {self.seconds:.2f}s ({rate:.2f} images/s), '
+            f'skipped {self.skipped} up-to-date, {len(self.failed)} failed.'
+        ]
+        for stage, seconds in self.stages.items():
+            per_image = seconds / self.images * 1000 if self.images else 0.0
+            lines.append(f'----- {stage:>6}: {seconds:.2f}s total, {per_image:.1f}ms per image.')
+        for src, error in self.failed:
+            lines.append(f'----- Failed `{src}`: {error}')
+        return '\n'.join(lines)
+
+def is_up_to_date(dst, *sources):
+    '''Whether `dst` exists and is newer than every source'''
+    if not dst.is_file():
+        return False
+    modified = dst.stat().st_mtime
+    return all(source.stat().st_mtime <= modified for source in sources if source is not None)
+
+def find_tasks(input_dir, output_dir, pattern='*', depth_dir=None, skip_up_to_date=True):
+    '''Pair every image matching `pattern` with its output and depth map paths
+
+    Outputs keep the path relative to `input_dir`, and depth maps are looked up under
+    the same relative path in `depth_dir`. Returns `(tasks, skipped)`.
+    '''
+    input_dir, output_dir = Path(input_dir), Path(output_dir)
+    tasks = []
+    skipped = 0
+    for src in sorted(input_dir.glob(pattern)):
+        if not src.is_file() or src.suffix.lower() not in image_suffixes:
+            continue
+        relative = src.relative_to(input_dir)
+        dst = output_dir / relative
+        depth = None
+        if depth_dir is not None:
+            depth = Path(depth_dir) / relative
+            if not depth.is_file():
+                continue
+        if skip_up_to_date and is_up_to_date(dst, src, depth):
+            skipped += 1
+            continue
+        tasks.append((src, dst, depth))
+    return tasks, skipped
+
+# Blur jobs of the current worker process, built once by `init_worker`
+worker_jobs = {}
+
+def init_worker(job_factory, settings, single_threaded=False):
+    '''Build the blur jobs once per worker process
+
+    Pool workers run single-threaded, since the processes already use every core.
+    '''
+    if single_threaded:
+        configure(max_workers=1, opencv_threads=1)
+    worker_jobs['blur'], worker_jobs['depth'] = job_factory(settings)
+
+def process_file(src, dst, depth=None):
+    '''Decode, blur and encode one image, returning the seconds spent in each stage'''
+    start = time.perf_counter()
+    img = cv2.imread(Path(src).absolute().as_posix())
+    if img is None:
+        raise ValueError('can not be read as an image')
+    depth_map = None
+    if depth is not None:
+        depth_map = cv2.imread(Path(depth).absolute().as_posix())
+        if depth_map is None:
+            raise ValueError('depth map can not be read as an image')
+    decoded = time.perf_counter()
+
+    if depth_map is None:
+        result = worker_jobs['blur'](img)
+    else:
+        result = worker_jobs['depth'](img, depth_map)
+    blurred = time.perf_counter()
+
+    Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    if not cv2.imwrite(Path(dst).absolute().as_posix(), result):
+        raise ValueError('can not be written')
+    encoded = time.perf_counter()
+
+    return {'decode': decoded - start, 'blur': blurred - decoded, 'encode': encoded - blurred}
+
+def run_directory(tasks, job_factory, settings, workers=1, max_in_flight=None):
+    '''Process `tasks` from `find_tasks` on a pool of `workers` processes
+
+    `job_factory(settings)` must be a picklable top-level function returning the
+    `(blur_job, depth_job)` pair; it runs once in every worker. At most `max_in_flight`
+    images (default: twice the workers) are submitted at a time.
+    '''
+    summary = Summary()
+    start = time.perf_counter()
+
+    if workers <= 1:
+        init_worker(job_factory, settings)
+        for src, dst, depth in tasks:
+            try:
+                summary.add(process_file(src, dst, depth))
+            except Exception as error:
+                summary.failed.append((src, error))
+        summary.seconds = time.perf_counter() - start
+        return summary
+
+    max_in_flight = max_in_flight or workers * 2
+    pending = {}
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(job_factory, settings, True)) as executor:
+        while True:
+            for src, dst, depth in tasks:
+                pending[executor.submit(process_file, src, dst, depth)] = src
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                src = pending.pop(future)
+                try:
+                    summary.add(future.result())
+                except Exception as error:
+                    summary.failed.append((src, error))
+
+    summary.seconds = time.perf_counter() - start
+    return summary
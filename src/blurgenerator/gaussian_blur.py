@@ -1,13 +1,86 @@
 """
 Gaussian blur generator
 """
+import math
 
 import cv2
 
-def gaussian_blur(img, kernel, sigma=5):
-    '''Gaussian blur generator'''
+from blurgenerator.profiling import stage
+
+GAUSSIAN_METHODS = ('exact', 'box', 'auto')
+
+# Kernel size from which `auto` switches to stacked box filters. Their cost does not
+# depend on the kernel. On doc/test.png, lens.png and depth-test.jpg they stay within
+# 5 levels of `cv2.GaussianBlur` as long as the boxes fit in the kernel and are at least
+# `box_min_width` wide. The mean abs error grows with sigma: about 0.1 to 0.25 up to
+# sigma 5, 0.25 to 0.45 up to sigma 20 (0.47 for kernel 101 with sigma 0), and up to
+# 0.75 once the blur spans a large part of the frame.
+box_min_kernel = 31
+
+# Narrowest box `auto` accepts. Stacks of 1 and 3 pixel boxes, i.e. sigmas below about
+# 2.5, are off by up to 20 levels on sharp edges.
+box_min_width = 5
+
+# Number of stacked box filters approximating one Gaussian
+box_passes = 3
+
+def get_sigma(kernel, sigma):
+    '''Standard deviation used by `cv2.GaussianBlur` for `kernel` and `sigma`'''
+    if sigma > 0:
+        return sigma
+    return 0.3 * ((kernel - 1) * 0.5 - 1) + 0.8
+
+def get_box_sizes(sigma, passes=box_passes):
+    '''Odd box widths whose stacked variance matches a Gaussian of `sigma`'''
+    ideal = math.sqrt(12 * sigma * sigma / passes + 1)
+    lower = int(math.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    lower = max(1, lower)
+    upper = lower + 2
+    count = round((12 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    count = min(passes, max(0, count))
+    return [lower] * count + [upper] * (passes - count)
+
+def box_gaussian_blur(img, sizes, dst=None):
+    '''Apply a stack of box filters, each a running sum whose cost does not depend on its size'''
+    if dst is None:
+        dst = img.copy()
+    elif dst is not img:
+        dst[...] = img
+    for size in sizes:
+        cv2.blur(dst, (size, size), dst=dst, borderType=cv2.BORDER_REFLECT_101)
+    return dst
+
+def choose_method(method, kernel, sizes):
+    '''Resolve `auto` to `box` for large kernels that hold the whole stack of wide enough boxes'''
+    if method not in GAUSSIAN_METHODS:
+        raise ValueError(f'Unknown method `{method}`. Please use one of {", ".join(GAUSSIAN_METHODS)}.')
+    if method != 'auto':
+        return method
+    reach = sum(size // 2 for size in sizes)
+    if kernel >= box_min_kernel and reach <= kernel // 2 and min(sizes) >= box_min_width:
+        return 'box'
+    return 'exact'
+
+def gaussian_blur(img, kernel, sigma=5, dst=None, method='auto'):
+    '''Gaussian blur generator
+
+    `method` is `exact`, `box` or `auto`. `box` approximates the Gaussian with three
+    stacked box filters, so its cost does not grow with `kernel`. `auto` uses it from
+    `box_min_kernel` on, when the kernel is wide enough for the box stack and the boxes
+    are at least `box_min_width` wide. The result
+    is written into `dst` when given.
+    '''
     if kernel % 2 == 0:
         kernel += 1
-    kernel_size = (kernel, kernel)
-    dst = cv2.GaussianBlur(img, kernel_size, sigma)
-    return dst
+    sizes = get_box_sizes(get_sigma(kernel, sigma))
+    method = choose_method(method, kernel, sizes)
+    with stage(f'gaussian.{method}') as timer:
+        if dst is None:
+            timer.add_bytes(img.nbytes)
+        if method == 'box':
+            return box_gaussian_blur(img, sizes, dst=dst)
+        kernel_size = (kernel, kernel)
+        dst = cv2.GaussianBlur(img, kernel_size, sigma, dst=dst)
+        return dst
@@ -0,0 +1,100 @@
+"""
+Kernel cache
+"""
+from typing import Any, Callable, Hashable, NamedTuple, Optional
+from collections import OrderedDict
+from threading import RLock
+
+
+class CacheInfo(NamedTuple):
+    """
+    Statistics of a kernel cache, in the spirit of `functools.lru_cache`.
+    """
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class KernelCache:
+    """
+    A bounded, thread-safe LRU cache for kernels.
+
+    Entries are created on demand by a factory and the least recently used
+    entry is evicted once more than `maxsize` entries are stored. When `weigh`
+    is given, `maxsize` bounds the sum of `weigh(entry)` instead, e.g. bytes.
+    """
+
+    def __init__(self, maxsize: int = 64, weigh: Optional[Callable[[Any], int]] = None):
+        if maxsize < 0:
+            raise ValueError('`maxsize` must be a non-negative integer.')
+        self._maxsize = maxsize
+        self._weigh = weigh or (lambda value: 1)
+        self._weights = {}
+        self._currsize = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Return the entry stored under `key`, building it with `factory` on a miss.
+        """
+        with self._lock:
+            if key in self._data:
+                self._hits += 1
+                self._data.move_to_end(key)
+                return self._data[key]
+            self._misses += 1
+
+        value = factory()
+
+        with self._lock:
+            if self._maxsize > 0 and key not in self._data:
+                self._data[key] = value
+                self._weights[key] = self._weigh(value)
+                self._currsize += self._weights[key]
+                self._evict()
+        return value
+
+    def _evict(self):
+        while self._currsize > self._maxsize:
+            key, _ = self._data.popitem(last=False)
+            self._currsize -= self._weights.pop(key)
+
+    def resize(self, maxsize: int):
+        """
+        Change the maximum number of entries, evicting the oldest ones if needed.
+        """
+        if maxsize < 0:
+            raise ValueError('`maxsize` must be a non-negative integer.')
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """
+        Drop all entries and reset the statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self._weights.clear()
+            self._currsize = 0
+            self._hits = 0
+            self._misses = 0
+
+    def info(self) -> CacheInfo:
+        """
+        Report hits, misses, maximum and current size.
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, self._currsize)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
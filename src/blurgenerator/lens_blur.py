@@ -1,16 +1,20 @@
 """
 Lens blur generator
 """
-from typing import Tuple, Dict, List
-import os
+from typing import Tuple, Dict, List, Optional
 import math
+import threading
 from functools import reduce
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Executor
 
 import cv2
 import numpy as np
 
+from blurgenerator.kernel_cache import KernelCache, CacheInfo
+from blurgenerator.convolution import choose_backend, fft_filter2d
+from blurgenerator.pool import run_tasks
+from blurgenerator.profiling import stage
+
 # These scales bring the size of the below components to roughly the specified radius - I just hard coded these
 kernel_scales = [1.4,1.2,1.2,1.2,1.2,1.2]
 
@@ -79,13 +83,13 @@ def normalise_kernels(kernels: List[np.ndarray], params: List[Dict[str, float]])
     """
     Normalises the kernels with respect to A*real + B*imag.
     """
-    total = 0
-
-    for k, p in zip(kernels, params):
-        for i in range(k.shape[1]):
-            for j in range(k.shape[1]):
-                total += p['A'] * (k[0, i].real * k[0, j].real - k[0, i].imag * k[0, j].imag) + \
-                         p['B'] * (k[0, i].real * k[0, j].imag + k[0, i].imag * k[0, j].real)
+    # The double sum over k[i] * k[j] of the 2D kernel equals the square of the 1D sum,
+    # so the total only needs one reduction per component.
+    sums = np.array([np.sum(k, dtype=np.complex128) for k in kernels])
+    squares = sums * sums
+    weights_a = np.array([p['A'] for p in params], dtype=np.float64)
+    weights_b = np.array([p['B'] for p in params], dtype=np.float64)
+    total = np.sum(weights_a * squares.real + weights_b * squares.imag)
 
     scalar = 1 / math.sqrt(total)
     kernels = np.asarray(kernels) * scalar
@@ -109,89 +113,291 @@ def multiply_kernel(kernel: np.ndarray) -> np.ndarray:
     b = np.repeat(kernel.transpose(), kernel_size, 1)
     return np.multiply(a, b)
 
-# ----------------------------------------------------------------
+# Working dtypes of the supported precisions
+precisions = {
+    'float32': np.float32,
+    'float64': np.float64,
+}
+
+# Supported quality modes
+qualities = ('exact', 'fast')
+
+# Radius, in pixels of the reduced image, that the `fast` quality convolves at
+fast_target_radius = 8
+
+# Bank of normalised component stacks keyed by (radius, component count)
+kernel_cache = KernelCache(maxsize=64)
+
+def build_components(radius: float, component_count: int) -> Tuple[np.ndarray, List[Dict[str, float]]]:
+    """
+    Build the normalised complex components and their parameters for a given radius.
+    """
+    with stage('lens.kernel_build'):
+        # Obtain component parameters / scale values
+        parameters, scale = get_parameters(component_count = component_count)
+        # Create each component for size radius, using scale and other component parameters
+        components = [complex_kernel_1d(radius, scale, component_params['a'], component_params['b']) for component_params in parameters]
+    with stage('lens.normalise_kernels'):
+        # Normalise all kernels together (the combination of all applied kernels in 2D must sum to 1)
+        components = normalise_kernels(components, parameters)
+    components.setflags(write=False)
+    return components, parameters
 
-def filter_task(idx: int, channel: int, img_channel: np.ndarray, component: np.ndarray, component_params: Dict[str, float]) -> Tuple[int, int, np.ndarray]:
+def get_components(radius: float, component_count: int) -> Tuple[np.ndarray, List[Dict[str, float]]]:
     """
-    Perform convolution with the complex kernel components on the image channel.
+    Obtain the normalised components for a given radius, building them only on a cache miss.
+    The returned arrays are shared between calls and therefore read-only.
     """
-    component_real = np.real(component)
-    component_imag = np.imag(component)
+    key = (float(radius), int(component_count))
+    return kernel_cache.get(key, lambda: build_components(radius, component_count))
 
-    component_real_t = component_real.transpose()
-    component_imag_t = component_imag.transpose()
-    
-    inter_real = cv2.filter2D(img_channel, -1, component_real, borderType=cv2.BORDER_REPLICATE)
-    inter_imag = cv2.filter2D(img_channel, -1, component_imag, borderType=cv2.BORDER_REPLICATE)
-    
-    final_1 = cv2.filter2D(inter_real, -1, component_real_t, borderType=cv2.BORDER_REPLICATE)
-    final_2 = cv2.filter2D(inter_real, -1, component_imag_t, borderType=cv2.BORDER_REPLICATE)
-    final_3 = cv2.filter2D(inter_imag, -1, component_real_t, borderType=cv2.BORDER_REPLICATE)
-    final_4 = cv2.filter2D(inter_imag, -1, component_imag_t, borderType=cv2.BORDER_REPLICATE)
-    
-    final = final_1 - final_4 + 1j * (final_2 + final_3)
-    weight_sum = weighted_sum(final, component_params)
-    
-    return idx, channel, weight_sum
+def get_kernel_cache_info() -> CacheInfo:
+    """
+    Report hits, misses, maximum and current size of the lens kernel cache.
+    """
+    return kernel_cache.info()
 
-def lens_blur(img: np.ndarray, radius: float = 3.0, components: int = 5, exposure_gamma: float = 5.0) -> np.ndarray:
+def set_kernel_cache_size(maxsize: int):
     """
-    Apply lens blur to the input image.
+    Change how many component stacks the lens kernel cache keeps.
+    """
+    kernel_cache.resize(maxsize)
+
+def clear_kernel_cache():
+    """
+    Drop all cached component stacks and reset the statistics.
+    """
+    kernel_cache.clear()
+
+# ----------------------------------------------------------------
+
+def get_fused_kernels(components: np.ndarray, parameters: List[Dict[str, float]]) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
     """
+    Real horizontal kernels and weighted vertical kernels of every component.
 
-    img = img/255.
+    For a component with horizontal passes `Re_h`, `Im_h` and weights A, B,
+    A*Re(F) + B*Im(F) of the complex result F equals
+    `Re_h * (A*re + B*im) + Im_h * (B*re - A*im)` along the vertical axis,
+    so two vertical passes with those kernels replace four passes and the complex sum.
+    """
+    fused = []
+    for component, component_params in zip(components, parameters):
+        component_real = np.ascontiguousarray(np.real(component))
+        component_imag = np.ascontiguousarray(np.imag(component))
+        weight_a, weight_b = component_params['A'], component_params['B']
+        vertical_real = (weight_a * component_real + weight_b * component_imag).transpose().copy()
+        vertical_imag = (weight_b * component_real - weight_a * component_imag).transpose().copy()
+        fused.append((component_real, component_imag, vertical_real, vertical_imag))
+    return fused
 
-    img = np.ascontiguousarray(img.transpose(2,0,1), dtype=np.float32)
-    # Obtain component parameters / scale values
-    parameters, scale = get_parameters(component_count = components)
-    # Create each component for size radius, using scale and other component parameters
-    components = [complex_kernel_1d(radius, scale, component_params['a'], component_params['b']) for component_params in parameters]
-    # Normalise all kernels together (the combination of all applied kernels in 2D must sum to 1)
-    components = normalise_kernels(components, parameters)
-    # Increase exposure to highlight bright spots
-    img = np.power(img, exposure_gamma)
+def filter_task(img: np.ndarray, kernels: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray], out: np.ndarray, lock: threading.Lock):
+    """
+    Convolve every channel of the HxWxC image with one fused component and add the result to `out`.
+    """
+    with stage('lens.filter_task'):
+        horizontal_real, horizontal_imag, vertical_real, vertical_imag = kernels
+        # Two buffers per task: the horizontal pass is reused for the imaginary part
+        inter = cv2.filter2D(img, -1, horizontal_real, borderType=cv2.BORDER_REPLICATE)
+        result = cv2.filter2D(inter, -1, vertical_real, borderType=cv2.BORDER_REPLICATE)
+        cv2.filter2D(img, -1, horizontal_imag, dst=inter, borderType=cv2.BORDER_REPLICATE)
+        cv2.filter2D(inter, -1, vertical_imag, dst=inter, borderType=cv2.BORDER_REPLICATE)
+        result += inter
+        with lock:
+            # OpenCV drops the channel axis of single channel images
+            out += result.reshape(out.shape)
 
-    # Process RGB channels for all components
+def spatial_convolve(img: np.ndarray, components: np.ndarray, parameters: List[Dict[str, float]], executor: Optional[Executor] = None) -> np.ndarray:
+    """
+    Convolve the CxHxW planes of `img` with the separable complex components and add them together.
+    Every component convolves all channels at once as one task on `executor`, or on the
+    shared pool when omitted. The result is a CxHxW view of an HxWxC array.
+    """
     # NOTE:
     # Let f,g be two complex signals. The convolution f*g can be split as:
     # Re(f)*Re(g) - Im(f)*Im(g) + i [Re(f)*Im(g) + Im(f)*Re(g)]
-    # where Re(), Im() represents the real and imaginary parts respectively
-
-    # Process RGB channels for all components
-    component_output = []
-
-    task_out = defaultdict(list)
-
-    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        tasks = []
-        for idx, (component, component_params) in enumerate(zip(components, parameters)):
-            for channel in range(img.shape[0]):
-                tasks.append(
-                    executor.submit(
-                        filter_task, idx, channel, img[channel], component, component_params
-                    )
-                )
-        for task in as_completed(tasks):
-            idx, channel, weight_sum = task.result()
-            task_out[idx].append((channel, weight_sum))
-
-    # sort out the output from thread pool & resort with original order
-    component_images = []
-    for idx, values in task_out.items():
-        component_image = np.stack([weight_sum for _, weight_sum in sorted(values, key=lambda x: x[0])])
-        component_images.append((idx, component_image))
-
-    # The final component output is a stack of RGB, with weighted sums of real and imaginary parts
-    component_output = [component_image for _, component_image in sorted(component_images, key=lambda x: x[0])]
-
-    # Add all components together
-    output_image = reduce(np.add, component_output)
-    # Reverse exposure
-    output_image = np.clip(output_image, 0, None)
-    output_image = np.power(output_image, 1.0/exposure_gamma)
+    # where Re(), Im() represents the real and imaginary parts respectively.
+    # Only the weighted sum of both parts is kept, see `get_fused_kernels`.
+
+    # OpenCV filters interleaved channels in one pass. Planes from `encode_gamma(..., interleaved=True)`
+    # are already views of an HxWxC array and are not copied.
+    interleaved = np.ascontiguousarray(img.transpose(1, 2, 0))
+    output_image = np.zeros_like(interleaved)
+    lock = threading.Lock()
+    run_tasks(
+        filter_task,
+        [(interleaved, kernels, output_image, lock) for kernels in get_fused_kernels(components, parameters)],
+        executor
+    )
+    return output_image.transpose(2, 0, 1)
+
+def get_kernel_2d(radius: float, component_count: int) -> np.ndarray:
+    """
+    Obtain the full 2D kernel, the weighted sum of all self-multiplied components.
+    Since the image is real, convolving with it equals the separable complex approach.
+    """
+    def build():
+        components, parameters = get_components(radius, component_count)
+        kernel = reduce(np.add, [weighted_sum(multiply_kernel(component), component_params) for component, component_params in zip(components, parameters)])
+        kernel = kernel.astype(np.float32)
+        kernel.setflags(write=False)
+        return kernel
+
+    key = ('2d', float(radius), int(component_count))
+    return kernel_cache.get(key, build)
+
+def fft_convolve(img: np.ndarray, radius: float, component_count: int, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Convolve the channels of `img` with the combined 2D kernel in the frequency domain.
+    Each channel is transformed once and multiplied by the cached kernel spectrum.
+    `out` may be `img` itself, since every channel is read before it is overwritten.
+    """
+    kernel = get_kernel_2d(radius, component_count)
+    key = ('lens', float(radius), int(component_count))
+    output_image = np.empty_like(img) if out is None else out
+    for channel in range(img.shape[0]):
+        fft_filter2d(img[channel], kernel, cv2.BORDER_REPLICATE, key=key, dst=output_image[channel])
+    return output_image
+
+def get_reduced_radius(radius: float) -> Optional[int]:
+    """
+    Radius the `fast` quality convolves at, or `None` when the radius is too small to gain from it.
+    """
+    if math.ceil(radius) < 2 * fast_target_radius:
+        return None
+    return fast_target_radius
+
+def get_halo(radius: float, quality: str = 'exact') -> int:
+    """
+    Pixels around a region that a lens blur of `radius` reads, so that blurring the region
+    grown by them matches a full-frame blur inside it, up to the resampling of `fast`.
+    """
+    halo = math.ceil(radius)
+    if quality == 'fast':
+        # Room for the resampling of the reduced image as well
+        halo += halo // fast_target_radius + 1
+    return halo
+
+def reduced_convolve(img: np.ndarray, radius: float, reduced_radius: int, component_count: int, backend: str = 'auto',
+                     executor: Optional[Executor] = None) -> np.ndarray:
+    """
+    Convolve the CxHxW planes of `img` with a kernel of `reduced_radius` on planes shrunk
+    by the same ratio, and upsample the result back into `img` with bilinear interpolation.
+    """
+    # Kernels span ceil(radius) pixels whatever the fraction, so the ratio is taken on those
+    scale = reduced_radius / math.ceil(radius)
+    height, width = img.shape[1:]
+    small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small = np.stack([cv2.resize(plane, small_size, interpolation=cv2.INTER_AREA) for plane in img])
+    kernel_size = reduced_radius * 2 + 1
+    if choose_backend(backend, 'lens', kernel_size, small_size[0] * small_size[1]) == 'fft':
+        small = fft_convolve(small, reduced_radius, component_count, out=small)
+    else:
+        components, parameters = get_components(reduced_radius, component_count)
+        small = spatial_convolve(small, components, parameters, executor)
+    for channel in range(img.shape[0]):
+        cv2.resize(small[channel], (width, height), dst=img[channel], interpolation=cv2.INTER_LINEAR)
+    return img
+
+# Gamma encoding tables for uint8 inputs keyed by (exposure gamma, dtype)
+gamma_cache = KernelCache(maxsize=16)
+
+def get_gamma_lut(exposure_gamma: float, dtype: np.dtype) -> np.ndarray:
+    """
+    256-entry table of `(value / 255) ** exposure_gamma`.
+    """
+    def build():
+        lut = np.power(np.arange(256, dtype=np.float64) / 255., exposure_gamma).astype(dtype)
+        lut.setflags(write=False)
+        return lut
+
+    return gamma_cache.get((float(exposure_gamma), np.dtype(dtype).str), build)
+
+def encode_gamma(img: np.ndarray, exposure_gamma: float, dtype: np.dtype, interleaved: bool = False) -> np.ndarray:
+    """
+    Scale an HxWxC image to [0, 1], raise it to `exposure_gamma` and return it as CxHxW planes of `dtype`.
+    uint8 images go through a lookup table, so no intermediate copy of the image is made.
+    With `interleaved`, the planes are a view of an HxWxC array, the layout the spatial convolution works on.
+    """
+    if interleaved:
+        planes = np.empty(img.shape, dtype=dtype).transpose(2, 0, 1)
+    else:
+        planes = np.empty((img.shape[2], img.shape[0], img.shape[1]), dtype=dtype)
+    if img.dtype == np.uint8:
+        lut = get_gamma_lut(exposure_gamma, dtype)
+        for channel in range(img.shape[2]):
+            np.take(lut, img[:, :, channel], out=planes[channel], mode='clip')
+        return planes
+    for channel in range(img.shape[2]):
+        np.multiply(img[:, :, channel], 1 / 255., out=planes[channel], casting='unsafe')
+    np.power(planes, exposure_gamma, out=planes)
+    return planes
+
+def decode_gamma(planes: np.ndarray, exposure_gamma: float, dst: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Reverse `encode_gamma` in place on `planes` and write the uint8 HxWxC result into `dst`.
+    """
+    np.maximum(planes, 0, out=planes)
+    np.power(planes, 1.0/exposure_gamma, out=planes)
     # Avoid out of range values - generally this only occurs with small negatives
     # due to imperfect complex kernels
-    output_image = np.clip(output_image, 0, 1)
-    output_image *= 255
-    output_image = output_image.transpose(1,2,0).astype(np.uint8)
-    return output_image
+    np.minimum(planes, 1, out=planes)
+    planes *= 255
+    if dst is None:
+        dst = np.empty((planes.shape[1], planes.shape[2], planes.shape[0]), dtype=np.uint8)
+    for channel in range(planes.shape[0]):
+        np.copyto(dst[:, :, channel], planes[channel], casting='unsafe')
+    return dst
+
+def lens_blur(img: np.ndarray, radius: float = 3.0, components: int = 5, exposure_gamma: float = 5.0, backend: str = 'auto',
+              executor: Optional[Executor] = None, dst: Optional[np.ndarray] = None, precision: str = 'float32',
+              quality: str = 'exact') -> np.ndarray:
+    """
+    Apply lens blur to the input image.
+
+    `backend` selects how the kernels are applied: `spatial` runs the separable
+    complex convolutions, `fft` multiplies the spectra of the image channels and
+    the combined kernel, and `auto` picks `fft` for large radii.
+    The spatial convolutions run on `executor` when given, otherwise on the shared pool
+    configured through `blurgenerator.pool.configure`.
+    `precision` is `float32`, which keeps every intermediate in single precision on both
+    backends, or `float64` for double precision at twice the memory.
+    `quality` is `exact`, or `fast` to convolve radii from twice `fast_target_radius` on
+    an image reduced so that the radius shrinks to `fast_target_radius`, then upsample the result.
+    The result is written into `dst` when given.
+    """
+    if precision not in precisions:
+        raise ValueError(f'Unknown precision `{precision}`. Please use `float32` or `float64`.')
+    if quality not in qualities:
+        raise ValueError(f'Unknown quality `{quality}`. Please use `exact` or `fast`.')
+    reduced_radius = get_reduced_radius(radius) if quality == 'fast' else None
+    component_count = components
+    kernel_size = int(math.ceil(radius)) * 2 + 1
+    requested_backend = backend
+    backend = choose_backend(backend, 'lens', kernel_size, img.shape[0] * img.shape[1])
+
+    with stage('lens.gamma_encode') as timer:
+        # Increase exposure to highlight bright spots
+        img = encode_gamma(img, exposure_gamma, precisions[precision], interleaved=backend == 'spatial' and reduced_radius is None)
+        timer.add_bytes(img.nbytes)
+
+    if reduced_radius is not None:
+        # The backend is chosen again for the reduced image and radius
+        with stage('lens.convolve_reduced'):
+            output_image = reduced_convolve(img, radius, reduced_radius, component_count, requested_backend, executor)
+    else:
+        with stage('lens.kernels'):
+            # Obtain the normalised components and their parameters from the kernel cache
+            components, parameters = get_components(radius, component_count)
+
+        with stage(f'lens.convolve_{backend}') as timer:
+            if backend == 'fft':
+                output_image = fft_convolve(img, radius, component_count, out=img)
+            else:
+                output_image = spatial_convolve(img, components, parameters, executor)
+                timer.add_bytes(output_image.nbytes)
+
+    with stage('lens.gamma_decode') as timer:
+        # Reverse exposure
+        if dst is None:
+            timer.add_bytes(output_image.size)
+        return decode_gamma(output_image, exposure_gamma, dst)
@@ -3,21 +3,189 @@ Motion blur generator
 
 """
 
+import math
 from random import randint
 
 import cv2
 import numpy as np
 
-def motion_blur(img, size=None, angle=None):
-    '''Motion blur generator'''
-    if size is None:
-        size = randint(20, 80)
-    if angle is None:
-        angle = randint(15, 30)
+from blurgenerator.kernel_cache import KernelCache, CacheInfo
+from blurgenerator.convolution import choose_backend, fft_filter_image
+from blurgenerator.profiling import stage
 
+MOTION_BACKENDS = ('spatial', 'fft', 'box', 'auto')
+
+# Kernel size from which `cv2.filter2D` convolves through a single precision DFT. Its
+# rounding then depends on the image size, so integer images are filtered in double
+# precision from this size on, which keeps depth layers and tiles equal to a full frame.
+dft_min_size = 12
+
+# Bank of normalised line kernels keyed by (size, angle)
+kernel_cache = KernelCache(maxsize=128)
+
+def motion_kernel(size, angle):
+    '''Normalised line kernel of `size` pixels rotated by `angle` degrees'''
     k = np.zeros((size, size), dtype=np.float32)
     k[(size-1)//2, :] = np.ones(size, dtype=np.float32)
     k = cv2.warpAffine(k, cv2.getRotationMatrix2D((size/2-0.5, size/2-0.5), angle, 1.0), (size, size))
     k = k * (1.0/np.sum(k))
+    return k
+
+def get_motion_kernel(size, angle):
+    '''Cached, read-only `motion_kernel(size, angle)`'''
+    def build():
+        k = motion_kernel(size, angle)
+        k.setflags(write=False)
+        return k
+
+    return kernel_cache.get((int(size), float(angle)), build)
+
+def get_kernel_cache_info() -> CacheInfo:
+    '''Report hits, misses, maximum and current size of the motion kernel cache'''
+    return kernel_cache.info()
+
+def set_kernel_cache_size(maxsize):
+    '''Change how many kernels the motion kernel cache keeps'''
+    kernel_cache.resize(maxsize)
+
+def clear_kernel_cache():
+    '''Drop all cached kernels and reset the statistics'''
+    kernel_cache.clear()
+
+def get_line_box(k):
+    '''Describe an axis-aligned line kernel as a 1-D box
+
+    Returns `(axis, length, anchor, shift)` where `axis` is 1 for a horizontal and 0
+    for a vertical line, or `None` when `k` is not a single uniform row or column.
+    '''
+    rows = np.flatnonzero(k.any(axis=1))
+    cols = np.flatnonzero(k.any(axis=0))
+    center = k.shape[0] // 2
+    if len(rows) == 1:
+        axis, line, start, stop, offset = 1, k[rows[0]], cols[0], cols[-1], rows[0]
+    elif len(cols) == 1:
+        axis, line, start, stop, offset = 0, k[:, cols[0]], rows[0], rows[-1], cols[0]
+    else:
+        return None
+    values = line[start:stop + 1]
+    if not np.allclose(values, values[0], rtol=1e-4, atol=0) or not start <= center <= stop:
+        return None
+    return axis, int(stop - start + 1), int(center - start), int(offset - center)
+
+def reflect_101(idx, length):
+    '''Map indices outside `[0, length)` like `cv2.BORDER_REFLECT_101`'''
+    if length == 1:
+        return np.zeros_like(idx)
+    period = 2 * length - 2
+    idx = np.abs(idx) % period
+    return np.where(idx >= length, period - idx, idx)
+
+def box_blur_aligned(img, box):
+    '''Exact running-sum equivalent of a horizontal or vertical line kernel'''
+    axis, length, anchor, shift = box
+    if axis == 1:
+        result = cv2.blur(img, (length, 1), anchor=(anchor, 0), borderType=cv2.BORDER_REFLECT_101)
+    else:
+        result = cv2.blur(img, (1, length), anchor=(0, anchor), borderType=cv2.BORDER_REFLECT_101)
+    if shift:
+        # The line sits off the kernel center, which shifts the result across the line
+        across = 0 if axis == 1 else 1
+        idx = reflect_101(np.arange(img.shape[across]) + shift, img.shape[across])
+        result = np.take(result, idx, axis=across)
+    return result
+
+def box_blur_rotated(img, k, size, angle):
+    '''Running-sum motion blur along an arbitrary direction
+
+    The image is rotated so the streak is horizontal, blurred with a 1-D box and
+    rotated back, so the cost is independent of `size`. The way back also moves the
+    box onto the centroid of `k`, which sits off the anchor for even sizes. The two
+    bilinear rotations soften the result slightly compared to the dense kernel.
+    '''
+    height, width = img.shape[:2]
+    diagonal = math.ceil(math.hypot(height, width))
+    pad_y = (diagonal - height) // 2 + size
+    pad_x = (diagonal - width) // 2 + size
+    padded = cv2.copyMakeBorder(img, pad_y, pad_y, pad_x, pad_x, cv2.BORDER_REFLECT_101).astype(np.float32)
+    padded_height, padded_width = padded.shape[:2]
+    center = (padded_width / 2 - 0.5, padded_height / 2 - 0.5)
+
+    forward = cv2.getRotationMatrix2D(center, -angle, 1.0)
+    rotated = cv2.warpAffine(padded, forward, (padded_width, padded_height), flags=cv2.INTER_LINEAR)
+    rotated = cv2.blur(rotated, (size, 1), borderType=cv2.BORDER_REFLECT_101)
+
+    # Offset between the kernel centroid and its anchor, minus the offset of the box
+    # center from its own anchor carried back into the image frame
+    anchor = size // 2
+    ys, xs = np.indices(k.shape)
+    centroid = np.array([np.sum(k * xs) - anchor, np.sum(k * ys) - anchor])
+    box_center = np.array([(size - 1) / 2 - anchor, 0.0])
+    rotation = forward[:, :2]
+    offset = centroid - np.linalg.solve(rotation, box_center)
+    inverse = forward.copy()
+    inverse[:, 2] += rotation @ offset
+    restored = cv2.warpAffine(rotated, inverse, (padded_width, padded_height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+    result = restored[pad_y:pad_y + height, pad_x:pad_x + width]
+    if np.issubdtype(img.dtype, np.integer):
+        limits = np.iinfo(img.dtype)
+        result = np.clip(np.rint(result), limits.min, limits.max)
+    return result.astype(img.dtype)
+
+def filter_double(img, k):
+    '''`cv2.filter2D` of an integer image computed in double precision, rounded and saturated like OpenCV'''
+    filtered = cv2.filter2D(img.astype(np.float64), -1, k.astype(np.float64))
+    limits = np.iinfo(img.dtype)
+    return np.clip(np.rint(filtered, out=filtered), limits.min, limits.max, out=filtered).astype(img.dtype)
+
+def choose_motion_backend(backend, k, size, area):
+    '''Resolve `auto` to the exact running sum for axis-aligned streaks, else to `spatial` or `fft`'''
+    if backend not in MOTION_BACKENDS:
+        raise ValueError(f'Unknown backend `{backend}`. Please use one of {", ".join(MOTION_BACKENDS)}.')
+    if backend == 'box':
+        return backend
+    if backend == 'auto' and get_line_box(k) is not None:
+        return 'box'
+    return choose_backend(backend, 'motion', size, area)
+
+def apply_motion_kernel(img, k, size, angle, backend='auto', dst=None):
+    '''Convolve `img` with a kernel built by `motion_kernel(size, angle)`'''
+    backend = choose_motion_backend(backend, k, size, img.shape[0] * img.shape[1])
+    with stage(f'motion.convolve_{backend}') as timer:
+        if dst is None:
+            timer.add_bytes(img.nbytes)
+        if backend == 'spatial' and (size < dft_min_size or not np.issubdtype(img.dtype, np.integer)):
+            return cv2.filter2D(img, -1, k, dst=dst)
+
+        if backend == 'spatial':
+            result = filter_double(img, k)
+        elif backend == 'fft':
+            result = fft_filter_image(img, k, cv2.BORDER_REFLECT_101, key=('motion', size, angle))
+        else:
+            box = kernel_cache.get(('box', int(size), float(angle)), lambda: get_line_box(k))
+            if box is None:
+                result = box_blur_rotated(img, k, size, angle)
+            else:
+                result = box_blur_aligned(img, box)
+        if dst is None:
+            return result
+        dst[...] = result
+        return dst
+
+def motion_blur(img, size=None, angle=None, backend='auto', dst=None):
+    '''Motion blur generator
+
+    `backend` is `spatial`, `fft`, `box` or `auto`. `box` applies the streak as a
+    running sum whose cost does not depend on `size`: exact for horizontal and
+    vertical streaks, through a rotated image otherwise, which only approximates the
+    dense kernel. `auto` uses it for axis-aligned streaks only, and the FFT for long
+    streaks. The result is written into `dst` when given.
+    '''
+    if size is None:
+        size = randint(20, 80)
+    if angle is None:
+        angle = randint(15, 30)
 
-    return cv2.filter2D(img, -1, k)
+    with stage('motion.kernel'):
+        k = get_motion_kernel(size, angle)
+    return apply_motion_kernel(img, k, size, angle, backend=backend, dst=dst)
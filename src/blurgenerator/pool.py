@@ -0,0 +1,125 @@
+"""
+Shared worker pool
+"""
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+import os
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+import cv2
+
+# Default cap on the number of worker threads shared by every blur call
+default_max_workers = min(32, os.cpu_count() or 1)
+
+lock = threading.Lock()
+local = threading.local()
+state = {
+    'executor': None,
+    'owned': False,
+    'max_workers': default_max_workers,
+}
+
+def mark_worker():
+    """
+    Thread initializer flagging the workers of the shared pool.
+    """
+    local.is_worker = True
+
+def in_worker() -> bool:
+    """
+    Whether the current thread is a worker of the shared pool.
+    """
+    return getattr(local, 'is_worker', False)
+
+def on_executor(executor: Executor) -> bool:
+    """
+    Whether the current thread runs a task of `executor`, either one submitted by
+    `run_tasks` or, for a `ThreadPoolExecutor`, any task submitted by the caller.
+    """
+    if id(executor) in getattr(local, 'executors', ()):
+        return True
+    current = threading.current_thread()
+    if current in getattr(executor, '_threads', ()):
+        return True
+    # A new worker may run its first task before the executor adds it to `_threads`,
+    # so it is also recognised by the work queue it was started with
+    work_queue = getattr(executor, '_work_queue', None)
+    return work_queue is not None and any(arg is work_queue for arg in getattr(current, '_args', ()))
+
+def run_marked(executor_id: int, fn: Callable[..., Any], *args) -> Any:
+    """
+    Run `fn(*args)` with the current thread flagged as a worker of the executor `executor_id`.
+    """
+    executors = local.__dict__.setdefault('executors', [])
+    executors.append(executor_id)
+    try:
+        return fn(*args)
+    finally:
+        executors.pop()
+
+def configure(max_workers: Optional[int] = None, executor: Optional[Executor] = None, opencv_threads: Optional[int] = None):
+    """
+    Configure the pool shared by all blur calls.
+
+    `max_workers` caps the number of threads of the built-in pool, `executor` replaces
+    it with a caller-owned executor, and `opencv_threads` is forwarded to `cv2.setNumThreads`
+    to keep OpenCV's own threads from oversubscribing the machine.
+    """
+    if max_workers is not None and max_workers < 1:
+        raise ValueError('`max_workers` must be a positive integer.')
+    with lock:
+        previous, owned = state['executor'], state['owned']
+        if max_workers is not None:
+            state['max_workers'] = max_workers
+        if executor is not None:
+            state['executor'], state['owned'] = executor, False
+        elif max_workers is not None:
+            state['executor'], state['owned'] = None, False
+        else:
+            previous = None
+    if previous is not None and owned:
+        previous.shutdown(wait=True)
+    if opencv_threads is not None:
+        cv2.setNumThreads(opencv_threads)
+
+def get_executor() -> Executor:
+    """
+    Return the shared executor, creating the built-in pool on first use.
+    """
+    with lock:
+        if state['executor'] is None:
+            state['executor'] = ThreadPoolExecutor(
+                max_workers=state['max_workers'],
+                thread_name_prefix='blurgenerator',
+                initializer=mark_worker
+            )
+            state['owned'] = True
+        return state['executor']
+
+def shutdown(wait: bool = True):
+    """
+    Shut down the built-in pool. It is created again on the next blur call.
+    """
+    with lock:
+        executor, owned = state['executor'], state['owned']
+        state['executor'], state['owned'] = None, False
+    if executor is not None and owned:
+        executor.shutdown(wait=wait)
+
+def run_tasks(fn: Callable[..., Any], arguments: Iterable[Tuple], executor: Optional[Executor] = None) -> List[Any]:
+    """
+    Run `fn(*args)` for every tuple in `arguments` and return the results in order.
+
+    Tasks go to `executor`, or to the shared pool when omitted. Calls made from a thread
+    of the target executor run inline, so nested blurs cannot deadlock waiting for a free
+    worker, whether the executor is the built-in pool or a caller-owned one.
+    """
+    arguments = list(arguments)
+    if executor is None:
+        if in_worker():
+            return [fn(*args) for args in arguments]
+        executor = get_executor()
+    if on_executor(executor):
+        return [fn(*args) for args in arguments]
+    tasks = [executor.submit(run_marked, id(executor), fn, *args) for args in arguments]
+    return [task.result() for task in tasks]
@@ -0,0 +1,141 @@
+"""
+Shared-memory process pool
+"""
+from typing import Any, Callable, Optional, Tuple
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python 3.7 has no shared memory blocks
+    shared_memory = None
+
+import numpy as np
+
+from blurgenerator.pool import configure
+
+lock = threading.Lock()
+state = {
+    'executor': None,
+    'processes': None,
+}
+
+class SharedArray:
+    """
+    NumPy array in a `multiprocessing.shared_memory` block.
+
+    The creating process owns the block and unlinks it on `close`. Other processes
+    `attach` to it through `descriptor()` and see the same pixels without a copy.
+    """
+
+    def __init__(self, shape: Tuple[int, ...], dtype: Any, name: Optional[str] = None):
+        check_shared_memory()
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    @classmethod
+    def copy_of(cls, array: np.ndarray) -> 'SharedArray':
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, descriptor: Tuple[str, Tuple[int, ...], str]) -> 'SharedArray':
+        name, shape, dtype = descriptor
+        return cls(shape, dtype, name=name)
+
+    def descriptor(self) -> Tuple[str, Tuple[int, ...], str]:
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        # Views of the buffer must be gone before the block can be closed
+        del self.array
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def check_shared_memory():
+    """
+    Raise a `RuntimeError` where `multiprocessing.shared_memory` is missing.
+    """
+    if shared_memory is None:
+        raise RuntimeError('Blurring depth layers on processes needs Python 3.8 or newer.')
+
+def init_process():
+    """
+    Worker initializer keeping every process single-threaded, since the pool already uses every core.
+    """
+    configure(max_workers=1, opencv_threads=1)
+
+def get_process_pool(processes: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    Return the module-level process pool, (re)creating it with `processes` workers.
+    Workers are started once and reused by every call, so OpenCV is imported once per process.
+    They are spawned rather than forked, since the parent already runs the shared thread
+    pool and OpenCV's threads.
+    """
+    check_shared_memory()
+    processes = processes or os.cpu_count() or 1
+    with lock:
+        if state['executor'] is None or state['processes'] != processes:
+            if state['executor'] is not None:
+                state['executor'].shutdown()
+            state['executor'] = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_process
+            )
+            state['processes'] = processes
+        return state['executor']
+
+def shutdown():
+    """
+    Shut the module-level process pool down.
+    """
+    with lock:
+        if state['executor'] is not None:
+            state['executor'].shutdown()
+        state['executor'] = None
+        state['processes'] = None
+
+def composite_layer(img: np.ndarray, labels: np.ndarray, out: np.ndarray, blur_job: Callable, label: int, blur_amount: int,
+                    box: Tuple[int, int, int, int], padded: Tuple[int, int, int, int]):
+    """
+    Blur the padded box of one layer and write it where `labels` equals `label`.
+    """
+    y0, y1, x0, x1 = box
+    py0, py1, px0, px1 = padded
+    blurred = blur_job(img[py0:py1, px0:px1], blur_amount)
+    region_mask = labels[y0:y1, x0:x1] == label
+    region = blurred[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+    out[y0:y1, x0:x1][region_mask] = region[region_mask]
+
+def blur_shared_layer(blur_job: Callable, img_descriptor, labels_descriptor, out_descriptor, label: int, blur_amount: int,
+                      box: Tuple[int, int, int, int], padded: Tuple[int, int, int, int]):
+    """
+    Worker task compositing one depth layer straight into the shared output.
+    Layers never share a pixel, so workers write to `out` without locking.
+    """
+    img = SharedArray.attach(img_descriptor)
+    labels = SharedArray.attach(labels_descriptor)
+    out = SharedArray.attach(out_descriptor)
+    try:
+        composite_layer(img.array, labels.array, out.array, blur_job, label, blur_amount, box, padded)
+    finally:
+        img.close()
+        labels.close()
+        out.close()
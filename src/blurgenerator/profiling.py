@@ -0,0 +1,155 @@
+"""
+Profiling hooks
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import time
+import threading
+from contextlib import contextmanager
+
+lock = threading.Lock()
+# `Stats` of every active `profile` block, replaced as a whole so readers need no lock
+state = {
+    'active': (),
+}
+
+class StageStats:
+    """
+    Call count, seconds and bytes allocated of one stage.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'calls': self.calls, 'seconds': self.seconds, 'bytes': self.bytes}
+
+class Stats:
+    """
+    Stages and depth layers recorded while `profile` is active.
+
+    `stages` maps stage names such as `lens.convolve` to their `StageStats`, and
+    `layers` lists one `{'kind', 'radius', 'pixels', 'seconds'}` entry per blurred
+    depth layer or blur level. Stages running on worker threads are summed, so their
+    seconds can exceed the wall time in `seconds`.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self.layers: List[Dict[str, Any]] = []
+        self.seconds = 0.0
+
+    def add(self, name: str, seconds: float, nbytes: int = 0):
+        with lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageStats()
+            stage.calls += 1
+            stage.seconds += seconds
+            stage.bytes += nbytes
+
+    def add_layer(self, kind: str, radius: float, pixels: int, seconds: float):
+        with lock:
+            self.layers.append({'kind': kind, 'radius': radius, 'pixels': pixels, 'seconds': seconds})
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'seconds': self.seconds,
+            'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+            'layers': list(self.layers),
+        }
+
+    def report(self) -> str:
+        lines = [f'----- Profiled {self.seconds:.4f}s.']
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            lines.append(f'----- {name:>24}: {stage.seconds:.4f}s in {stage.calls} calls, {stage.bytes / 2**20:.1f} MiB allocated.')
+        for layer in self.layers:
+            lines.append(f'----- {layer["kind"]:>12} radius {layer["radius"]}: {layer["pixels"]} px in {layer["seconds"]:.4f}s.')
+        return '\n'.join(lines)
+
+class Stage:
+    """
+    Times one stage into every `Stats` of `active`. Allocations are reported with `add_bytes`.
+    """
+
+    def __init__(self, active: Tuple[Stats, ...], name: str):
+        self.active = active
+        self.name = name
+        self.nbytes = 0
+
+    def add_bytes(self, nbytes: int):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        for stats in self.active:
+            stats.add(self.name, seconds, self.nbytes)
+        return False
+
+class NullStage:
+    """
+    Stand-in for `Stage` while profiling is off.
+    """
+
+    def add_bytes(self, nbytes: int):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+null_stage = NullStage()
+
+def stage(name: str):
+    """
+    Context manager timing the stage `name`, or a shared no-op when profiling is off.
+    """
+    active = state['active']
+    if not active:
+        return null_stage
+    return Stage(active, name)
+
+def record_layer(kind: str, radius: float, pixels: int, seconds: float):
+    """
+    Record the blur radius, pixel count and seconds of one depth layer.
+    """
+    for stats in state['active']:
+        stats.add_layer(kind, radius, pixels, seconds)
+
+def enabled() -> bool:
+    """
+    Whether a `profile` block is active.
+    """
+    return bool(state['active'])
+
+@contextmanager
+def profile(stats: Optional[Stats] = None):
+    """
+    Record every blur stage run inside the block, on any thread, into a `Stats`.
+    Blocks may overlap, on the same or different threads, and each one records the
+    stages run while it is active.
+
+        with profile() as stats:
+            lens_blur(img, radius=5)
+        print(stats.report())
+    """
+    stats = stats or Stats()
+    with lock:
+        state['active'] += (stats,)
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.seconds += time.perf_counter() - start
+        with lock:
+            # Remove this block's own entry, whatever the order blocks exit in
+            active = list(state['active'])
+            active.remove(stats)
+            state['active'] = tuple(active)
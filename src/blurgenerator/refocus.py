@@ -0,0 +1,112 @@
+"""
+Refocus session
+"""
+from typing import Callable, Iterable, Iterator, Optional
+from functools import partial
+
+import numpy as np
+import cv2
+
+from blurgenerator.depth import map_range, to_gray, label_depth_map, iter_layer_masks, interpolate_blur_stack, lens_layer, NO_LAYER
+from blurgenerator.kernel_cache import KernelCache, CacheInfo
+from blurgenerator.profiling import stage
+
+# Default cap on the bytes of blurred images kept by a session
+default_max_bytes = 1024 * 2**20
+
+
+class RefocusSession:
+    """
+    Render many depth of field settings of one image, blurring each radius once.
+
+    Every rendering is a composite of full-frame blurs of the image, one per distinct
+    blur amount, so the blurs are memoised by amount and shared by every focal plane,
+    aperture (`max_blur`) and layer configuration rendered afterwards. The least recently
+    used blurs are dropped once they hold more than `max_bytes`.
+
+    `blur_job(img, blur_amount)` defaults to the lens blur of `lens_blur_with_depth_map`
+    with `components`, `exposure_gamma` and `quality`.
+    """
+
+    def __init__(self, img: np.ndarray, depth_map: np.ndarray, components: int = 5, exposure_gamma: float = 5,
+                 quality: str = 'exact', blur_job: Optional[Callable] = None, max_bytes: int = default_max_bytes):
+        self.img = img
+        self.depth = to_gray(depth_map)
+        self.blur_job = blur_job or partial(lens_layer, components=components, exposure_gamma=exposure_gamma, quality=quality)
+        self._blurs = KernelCache(maxsize=max_bytes, weigh=lambda blurred: blurred.nbytes)
+
+    def blur(self, blur_amount: int) -> np.ndarray:
+        """
+        Full-frame blur of the image by `blur_amount`, computed once while it stays cached.
+        """
+        def build():
+            with stage('refocus.blur'):
+                return self.blur_job(self.img, blur_amount)
+        return self._blurs.get(blur_amount, build)
+
+    def distance(self, focus: int) -> np.ndarray:
+        """
+        Distance of every pixel's depth to the focal plane at depth `focus`.
+        """
+        if not 0 <= focus <= 255:
+            raise ValueError('`focus` must be a depth between 0 and 255.')
+        lut = np.abs(np.arange(256) - int(focus)).astype(np.uint8)
+        return cv2.LUT(self.depth, lut)
+
+    def render(self, focus: int = 0, num_layers: int = 10, min_blur: int = 1, max_blur: int = 100,
+               continuous: bool = False, num_levels: int = 5, dst: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Depth blur focused on depth `focus`, in the depth map's 0 to 255 units.
+
+        Blur amounts grow from `min_blur` to `max_blur` with the distance to the focal
+        plane, so `focus=0` gives the layers of `lens_blur_with_depth_map` with the same
+        parameters, and a wider aperture is a larger `max_blur`. Unlike those functions,
+        the pixels nearest to the focal plane, which no layer starts below, are kept in a
+        layer of their own instead of being left black.
+        """
+        distance = self.distance(focus)
+        blur_job = lambda img, blur_amount: self.blur(blur_amount)
+        if continuous:
+            return interpolate_blur_stack(self.img, distance, blur_job, num_levels=num_levels, min_blur=min_blur, max_blur=max_blur, out=dst)
+
+        with stage('depth.labels'):
+            labels, blur_amounts = label_depth_map(distance, num_layers=num_layers, min_blur=min_blur, max_blur=max_blur)
+            nearest = int(map_range(int(distance.min()), 0, 255, min_blur, max_blur))
+            if nearest not in blur_amounts:
+                blur_amounts.append(nearest)
+            labels[labels == NO_LAYER] = blur_amounts.index(nearest)
+        out = np.zeros_like(self.img) if dst is None else dst
+        if dst is not None:
+            out[...] = 0
+        for label, mask in iter_layer_masks(labels, len(blur_amounts)):
+            if not mask.any():
+                continue
+            blurred = self.blur(blur_amounts[label])
+            with stage('depth.composite'):
+                np.copyto(out, blurred, where=mask[:, :, None] if out.ndim == 3 else mask)
+        return out
+
+    def sweep(self, focuses: Iterable[int], **params) -> Iterator[np.ndarray]:
+        """
+        Yield a rendering per focal plane of `focuses`, e.g. the frames of a focus pull.
+        """
+        for focus in focuses:
+            yield self.render(focus, **params)
+
+    def resize(self, max_bytes: int):
+        """
+        Change the cap on cached blurs, dropping the least recently used ones if needed.
+        """
+        self._blurs.resize(max_bytes)
+
+    def clear(self):
+        """
+        Drop all cached blurs and reset the statistics.
+        """
+        self._blurs.clear()
+
+    def info(self) -> CacheInfo:
+        """
+        Report blur hits, misses, and the maximum and current bytes cached.
+        """
+        return self._blurs.info()
@@ -0,0 +1,209 @@
+"""
+Result cache
+"""
+from typing import Any, Callable, Dict, Iterable, Optional
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+from threading import RLock
+
+import numpy as np
+
+from blurgenerator import __version__
+from blurgenerator.kernel_cache import CacheInfo
+
+# Default cap on the bytes stored in a cache directory
+default_max_bytes = 1024 * 2**20
+
+# Keyword arguments that do not change a result and are left out of the key
+ignored_params = ('dst', 'out', 'executor', 'processes')
+
+
+class ResultCache:
+    """
+    Content-addressed cache of blur results in a local directory.
+
+    Results are stored as `.npy` files named after a SHA-256 of the function name,
+    its parameters and the pixels of every input array. Reading an entry refreshes
+    its modification time, and the least recently used files are deleted once the
+    directory holds more than `max_bytes`. Several processes may share a directory.
+
+    The size of the directory is scanned once and then kept as a running total of the
+    entries this instance writes, so the directory is only scanned again when that
+    total passes `max_bytes`. Entries written by other processes are counted from the
+    next scan on.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = default_max_bytes):
+        if max_bytes < 0:
+            raise ValueError('`max_bytes` must be a non-negative integer.')
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = RLock()
+        self._hits = 0
+        self._misses = 0
+        self._currsize = sum(size for _, size, _ in self._entries())
+
+    def key(self, name: str, arrays: Iterable[np.ndarray], params: Dict[str, Any]) -> str:
+        """
+        Hash of `name`, `params` and the shape, dtype and pixels of `arrays`.
+        """
+        digest = hashlib.sha256()
+        # Results of another release may differ, so the version is part of every key
+        digest.update(__version__.encode('utf-8'))
+        digest.update(name.encode('utf-8'))
+        digest.update(json.dumps(params, sort_keys=True, default=repr).encode('utf-8'))
+        for array in arrays:
+            if array is None:
+                digest.update(b'none')
+                continue
+            array = np.ascontiguousarray(array)
+            digest.update(f'{array.shape}{array.dtype.str}'.encode('utf-8'))
+            digest.update(memoryview(array).cast('B'))
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.directory / key[:2] / f'{key}.npy'
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Load the result stored under `key`, or `None` on a miss.
+        """
+        path = self.path(key)
+        try:
+            result = np.load(path.as_posix())
+            os.utime(path.as_posix())
+        except (OSError, ValueError):
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+        return result
+
+    def put(self, key: str, result: np.ndarray):
+        """
+        Store `result` under `key` and evict old entries beyond the size cap.
+        """
+        if self._max_bytes == 0:
+            return
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        # Write to a temporary file first, so readers never see a partial entry
+        handle, temporary = tempfile.mkstemp(dir=path.parent.as_posix(), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as fh:
+                np.save(fh, result)
+            size = os.path.getsize(temporary)
+            with self._lock:
+                try:
+                    replaced = path.stat().st_size
+                except OSError:
+                    replaced = 0
+                os.replace(temporary, path.as_posix())
+                self._currsize += size - replaced
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        if self._currsize > self._max_bytes:
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob('*/*.npy'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self._max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+            self._currsize = total
+
+    def lookup(self, name: str, arrays: Iterable[np.ndarray], params: Dict[str, Any], compute: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Return the result stored for `name`, `arrays` and `params`, storing `compute()` on a miss.
+        """
+        key = self.key(name, arrays, params)
+        result = self.get(key)
+        if result is None:
+            result = compute()
+            self.put(key, result)
+        return result
+
+    def call(self, function: Callable, *arrays: np.ndarray, name: Optional[str] = None, **params) -> np.ndarray:
+        """
+        Return `function(*arrays, **params)` from the cache, computing and storing it on a miss.
+
+        `arrays` are the positional inputs (image and depth map) and `params` the keyword
+        parameters. `dst`, `executor` and `processes` are passed through but not hashed.
+        """
+        name = name or f'{function.__module__}.{function.__qualname__}'
+        key_params = {param: value for param, value in params.items() if param not in ignored_params}
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return function(*arrays, **params)
+
+        result = self.lookup(name, arrays, key_params, compute)
+        dst = params.get('dst')
+        if dst is not None and not computed:
+            dst[...] = result
+            result = dst
+        return result
+
+    def wrap(self, job: Callable, name: str, params: Dict[str, Any]) -> Callable:
+        """
+        Cache the results of `job(*arrays)`, whose parameters `params` are already bound.
+        """
+        def cached(*arrays):
+            return self.lookup(name, arrays, params, lambda: job(*arrays))
+
+        cached.cache = self
+        return cached
+
+    def resize(self, max_bytes: int):
+        """
+        Change the size cap, evicting the oldest entries if needed.
+        """
+        if max_bytes < 0:
+            raise ValueError('`max_bytes` must be a non-negative integer.')
+        self._max_bytes = max_bytes
+        self._evict()
+
+    def clear(self):
+        """
+        Delete all entries and reset the statistics.
+        """
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+            self._currsize = 0
+            self._hits = 0
+            self._misses = 0
+
+    def info(self) -> CacheInfo:
+        """
+        Report hits, misses, maximum and current size in bytes.
+        """
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._max_bytes, self._currsize)
@@ -0,0 +1,221 @@
+"""
+Micro-batching blur service
+"""
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cv2
+import numpy as np
+
+from blurgenerator.batch import motion_blur_batch, lens_blur_batch, gaussian_blur_batch
+
+# Batch function and typed parameters with their defaults of every blur served
+jobs = {
+    'motion': (motion_blur_batch, {'size': (int, 100), 'angle': (float, 30.0)}),
+    'lens': (lens_blur_batch, {'radius': (float, 5.0), 'components': (int, 4), 'exposure_gamma': (float, 2.0), 'quality': (str, 'exact')}),
+    'gaussian': (gaussian_blur_batch, {'kernel': (int, 100), 'sigma': (float, 5.0)}),
+}
+
+def parse_params(kind, query):
+    '''Typed parameters of `kind` from a parsed query string, filling in the defaults'''
+    if kind not in jobs:
+        raise ValueError(f'Unknown blur `{kind}`. Please use one of {", ".join(jobs)}.')
+    _, spec = jobs[kind]
+    unknown = set(query) - set(spec)
+    if unknown:
+        raise ValueError(f'Unknown parameters {", ".join(sorted(unknown))} for `{kind}`.')
+    params = {}
+    for name, (cast, default) in spec.items():
+        params[name] = cast(query[name][-1]) if name in query else default
+    return params
+
+class Pending:
+    '''One queued image and the future its result is delivered to'''
+
+    def __init__(self, key, image):
+        self.key = key
+        self.image = image
+        self.future = Future()
+        self.queued = time.perf_counter()
+
+class MicroBatcher:
+    '''Group concurrent requests with identical parameters into batches
+
+    `workers` threads take the oldest pending request, wait up to `max_delay` seconds
+    for more requests with the same blur and parameters, and run up to `max_batch` of
+    them through one `*_batch` call, which shares kernels and the worker pool.
+    '''
+
+    def __init__(self, max_batch=8, max_delay=0.005, workers=1, history=1000):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.latencies = deque(maxlen=history)
+        self.requests = 0
+        self.batches = 0
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, kind, params, image):
+        '''Queue `image` and return a future of its blurred result'''
+        item = Pending((kind, tuple(sorted(params.items()))), image)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('The batcher is closed.')
+            self.pending.append(item)
+            self.condition.notify()
+        return item.future
+
+    def take_batch(self):
+        '''Pop the oldest request and its batch mates, or `None` once closed'''
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            key = self.pending[0].key
+            deadline = self.pending[0].queued + self.max_delay
+            while not self.closed:
+                count = sum(1 for item in self.pending if item.key == key)
+                remaining = deadline - time.perf_counter()
+                if count >= self.max_batch or remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = []
+            for item in list(self.pending):
+                if item.key == key and len(batch) < self.max_batch:
+                    self.pending.remove(item)
+                    batch.append(item)
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            if batch is None:
+                return
+            if not batch:
+                # Another worker took these requests while this one was waiting
+                continue
+            kind, params = batch[0].key
+            function, _ = jobs[kind]
+            try:
+                results = function([item.image for item in batch], **dict(params))
+            except Exception as error:
+                for item in batch:
+                    item.future.set_exception(error)
+                continue
+            done = time.perf_counter()
+            with self.condition:
+                self.requests += len(batch)
+                self.batches += 1
+                self.latencies.extend(done - item.queued for item in batch)
+            for item, result in zip(batch, results):
+                item.future.set_result(result)
+
+    def stats(self):
+        '''Queue depth, batch counts and latency percentiles in milliseconds'''
+        with self.condition:
+            latencies = sorted(self.latencies)
+            report = {
+                'queue_depth': len(self.pending),
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            }
+        report['latency_ms'] = {
+            f'p{percentile}': latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))] * 1000 if latencies else 0.0
+            for percentile in [50, 90, 99]
+        }
+        return report
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+class BlurHandler(BaseHTTPRequestHandler):
+    '''`POST /blur/<kind>?param=value` with an encoded image body returns a PNG, `GET /stats` returns JSON'''
+
+    quiet = True
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_text(self, status, message):
+        self.send_body(status, message.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/stats':
+            self.send_body(200, json.dumps(self.server.batcher.stats()).encode('utf-8'), 'application/json')
+        elif path == '/health':
+            self.send_error_text(200, 'ok')
+        else:
+            self.send_error_text(404, f'`{path}` not found.')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != 'blur':
+            self.send_error_text(404, f'`{url.path}` not found. Please post to `/blur/<kind>`.')
+            return
+        try:
+            params = parse_params(parts[1], parse_qs(url.query))
+        except ValueError as error:
+            self.send_error_text(400, str(error))
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        data = np.frombuffer(self.rfile.read(length), dtype=np.uint8)
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR) if data.size else None
+        if img is None:
+            self.send_error_text(400, 'The body can not be decoded as an image.')
+            return
+
+        try:
+            result = self.server.batcher.submit(parts[1], params, img).result()
+        except Exception as error:
+            self.send_error_text(500, str(error))
+            return
+        ok, encoded = cv2.imencode('.png', result)
+        if not ok:
+            self.send_error_text(500, 'The result can not be encoded.')
+            return
+        self.send_body(200, encoded.tobytes(), 'image/png')
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+def make_server(host='127.0.0.1', port=8000, max_batch=8, max_delay=0.005, workers=1):
+    '''HTTP server bound to `host:port` with its own `MicroBatcher` as `server.batcher`'''
+    server = ThreadingHTTPServer((host, port), BlurHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(max_batch=max_batch, max_delay=max_delay, workers=workers)
+    return server
+
+def serve(host='127.0.0.1', port=8000, max_batch=8, max_delay=0.005, workers=1):
+    '''Serve blurs until interrupted'''
+    server = make_server(host, port, max_batch=max_batch, max_delay=max_delay, workers=workers)
+    print(f'----- Serving blurs on http://{server.server_address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
@@ -0,0 +1,195 @@
+"""
+Streaming blur pipeline
+"""
+import time
+import queue
+import threading
+from pathlib import Path
+
+import cv2
+
+video_suffixes = ['.mp4', '.avi', '.mov', '.mkv', '.m4v', '.webm']
+image_suffixes = ['.jpg', '.jpeg', '.png']
+
+# FourCC used by `cv2.VideoWriter` for each output container
+fourcc_codes = {
+    '.mp4': 'mp4v',
+    '.m4v': 'mp4v',
+    '.mov': 'mp4v',
+    '.avi': 'MJPG',
+    '.mkv': 'MJPG',
+}
+
+def is_video(path):
+    '''Whether `path` names a video file'''
+    return Path(path).suffix.lower() in video_suffixes
+
+def is_stream(path):
+    '''Whether `path` is a video file or a directory of frames'''
+    return Path(path).is_dir() or is_video(path)
+
+def list_frames(folder, suffixes=None):
+    '''Image files of a directory, sorted by name'''
+    suffixes = suffixes or image_suffixes
+    return sorted(path for path in Path(folder).iterdir() if path.suffix.lower() in suffixes)
+
+def open_source(path, fps=30.0):
+    '''Open a video or a directory of frames, returning `(frames, fps)`
+
+    `frames` is an iterator of decoded BGR frames. Directories play at `fps`.
+    '''
+    path = Path(path)
+    if path.is_dir():
+        files = list_frames(path)
+        frames = (cv2.imread(file.absolute().as_posix()) for file in files)
+        return frames, fps
+
+    capture = cv2.VideoCapture(path.absolute().as_posix())
+    if not capture.isOpened():
+        raise ValueError(f'`{path}` can not be opened as a video.')
+    source_fps = capture.get(cv2.CAP_PROP_FPS) or fps
+
+    def frames():
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield frame
+        finally:
+            capture.release()
+
+    return frames(), source_fps
+
+class FrameWriter:
+    '''Lazily opened `cv2.VideoWriter`, sized by the first frame it receives'''
+
+    def __init__(self, path, fps):
+        self.path = Path(path)
+        self.fps = fps
+        self.writer = None
+
+    def write(self, frame):
+        if self.writer is None:
+            code = fourcc_codes.get(self.path.suffix.lower(), 'mp4v')
+            height, width = frame.shape[:2]
+            self.writer = cv2.VideoWriter(self.path.absolute().as_posix(), cv2.VideoWriter_fourcc(*code), self.fps, (width, height))
+            if not self.writer.isOpened():
+                raise ValueError(f'`{self.path}` can not be opened for writing.')
+        self.writer.write(frame)
+
+    def release(self):
+        if self.writer is not None:
+            self.writer.release()
+
+# Marks the end of a queue
+done = object()
+
+class Failure:
+    '''Exception raised in a pipeline thread, forwarded to the consumer'''
+
+    def __init__(self, error):
+        self.error = error
+
+def put(target, item, stop):
+    '''Put `item` on a bounded queue unless the pipeline is stopping'''
+    while not stop.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def get(source, stop):
+    '''Get the next item of a queue, or `done` once the pipeline is stopping'''
+    while not stop.is_set():
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return done
+
+def run_pipeline(frames, blur_job, write, prefetch=8, workers=1):
+    '''Decode, blur and encode frames on overlapping threads
+
+    `frames` yields the arguments of `blur_job` (a frame, or a tuple of frame and depth
+    frame). Decoding runs on its own thread, `workers` threads blur, and the calling
+    thread writes the results in their original order. At most `prefetch` frames wait
+    between two stages. Returns the number of frames written.
+    '''
+    stop = threading.Event()
+    decoded = queue.Queue(maxsize=prefetch)
+    blurred = queue.Queue(maxsize=prefetch)
+
+    def decode():
+        try:
+            for idx, item in enumerate(frames):
+                if not put(decoded, (idx, item), stop):
+                    return
+        except Exception as error:
+            put(blurred, Failure(error), stop)
+        finally:
+            for _ in range(workers):
+                put(decoded, done, stop)
+
+    def blur():
+        try:
+            while True:
+                item = get(decoded, stop)
+                if item is done:
+                    break
+                idx, args = item
+                args = args if isinstance(args, tuple) else (args,)
+                if not put(blurred, (idx, blur_job(*args)), stop):
+                    return
+        except Exception as error:
+            put(blurred, Failure(error), stop)
+        finally:
+            put(blurred, done, stop)
+
+    threads = [threading.Thread(target=decode, daemon=True)]
+    threads += [threading.Thread(target=blur, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    pending = {}
+    next_idx = 0
+    finished = 0
+    try:
+        while finished < workers:
+            item = blurred.get()
+            if item is done:
+                finished += 1
+                continue
+            if isinstance(item, Failure):
+                raise item.error
+            idx, result = item
+            pending[idx] = result
+            while next_idx in pending:
+                write(pending.pop(next_idx))
+                next_idx += 1
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return next_idx
+
+def blur_stream(src, dst, blur_job, depth_src=None, fps=30.0, prefetch=8, workers=1):
+    '''Blur a video or directory of frames into a video file
+
+    With `depth_src`, `blur_job(frame, depth_frame)` receives the frame-aligned depth
+    stream, which ends with the shorter of both streams. Returns `(frames, seconds)`.
+    '''
+    frames, source_fps = open_source(src, fps)
+    if depth_src is not None:
+        depth_frames, _ = open_source(depth_src, fps)
+        frames = zip(frames, depth_frames)
+
+    writer = FrameWriter(dst, source_fps)
+    start = time.perf_counter()
+    try:
+        count = run_pipeline(frames, blur_job, writer.write, prefetch=prefetch, workers=workers)
+    finally:
+        writer.release()
+    return count, time.perf_counter() - start
@@ -0,0 +1,139 @@
+"""
+Tiled blur generator
+"""
+import math
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from blurgenerator.motion_blur import motion_blur, get_motion_kernel, get_line_box, choose_motion_backend
+from blurgenerator.lens_blur import lens_blur, get_halo
+from blurgenerator.gaussian_blur import gaussian_blur
+
+# Default peak working memory per tile
+default_memory_budget = 256 * 2**20
+
+# Approximate working memory of each blur per pixel of a padded 3-channel uint8 tile,
+# measured with `benchmarks/lens_memory.py`-style tracemalloc runs. The running sum of
+# a rotated streak keeps float32 copies of the tile padded to its diagonal plus the
+# streak, so its figure is per pixel of that working image. Dense motion kernels filter
+# 8-bit tiles in double precision.
+bytes_per_pixel = {
+    'lens': 80,
+    'motion': 56,
+    'motion_rotated': 50,
+    'gaussian': 16,
+}
+
+min_tile_size = 64
+
+def open_image(src, mode='r'):
+    '''Open `src` as an array without loading `.npy` files into memory
+
+    `src` may be an array (including a `numpy.memmap`), a path to a `.npy` file which
+    is memory-mapped, or a path to an image readable by `cv2.imread`.
+    '''
+    if isinstance(src, np.ndarray):
+        return src
+    path = Path(src)
+    if path.suffix == '.npy':
+        return np.load(path.as_posix(), mmap_mode=mode)
+    img = cv2.imread(path.absolute().as_posix())
+    if img is None:
+        raise ValueError(f'`{src}` can not be read as an image.')
+    return img
+
+def create_output(dst, shape, dtype):
+    '''Resolve `dst` into a writable array, creating a memory-mapped `.npy` for paths'''
+    if dst is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(dst, np.ndarray):
+        if dst.shape != shape:
+            raise ValueError(f'`dst` has shape {dst.shape}, expected {shape}.')
+        return dst
+    return np.lib.format.open_memmap(Path(dst).as_posix(), mode='w+', dtype=dtype, shape=shape)
+
+def get_tile_size(halo, kind, channels=3, memory_budget=default_memory_budget):
+    '''Largest square tile whose padded working set fits in `memory_budget` bytes'''
+    per_pixel = bytes_per_pixel[kind] * max(1, channels) / 3
+    padded_side = int(math.sqrt(memory_budget / per_pixel))
+    if kind == 'motion_rotated':
+        # Side of the padded tile whose diagonal plus the streak on both sides fits
+        padded_side = int((padded_side - 2 * halo) / math.sqrt(2))
+    return max(min_tile_size, padded_side - 2 * halo)
+
+def iter_tiles(height, width, tile_size, halo):
+    '''Yield the core and padded `(y0, y1, x0, x1)` boxes covering an image'''
+    for y0 in range(0, height, tile_size):
+        y1 = min(height, y0 + tile_size)
+        for x0 in range(0, width, tile_size):
+            x1 = min(width, x0 + tile_size)
+            padded = (max(0, y0 - halo), min(height, y1 + halo), max(0, x0 - halo), min(width, x1 + halo))
+            yield (y0, y1, x0, x1), padded
+
+def blur_tiled(src, blur_job, halo, dst=None, tile_size=None, kind='lens', memory_budget=default_memory_budget):
+    '''Apply `blur_job(tile)` over overlapping tiles of `src` and stitch them into `dst`
+
+    Only one padded tile is held in memory at a time, so `src` and `dst` can be
+    memory-mapped files larger than RAM. `halo` is the kernel reach in pixels, which
+    makes the stitched result match a blur of the whole image. The tile size is
+    derived from `memory_budget` unless given explicitly. Memory-mapped outputs are
+    flushed before returning.
+    '''
+    src = open_image(src)
+    out = create_output(dst, src.shape, src.dtype)
+    height, width = src.shape[:2]
+    channels = src.shape[2] if src.ndim == 3 else 1
+    if tile_size is None:
+        tile_size = get_tile_size(halo, kind, channels, memory_budget)
+
+    for (y0, y1, x0, x1), (py0, py1, px0, px1) in iter_tiles(height, width, tile_size, halo):
+        tile = np.ascontiguousarray(src[py0:py1, px0:px1])
+        result = blur_job(tile)
+        out[y0:y1, x0:x1] = result[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+def lens_blur_tiled(src, dst=None, radius=3.0, components=5, exposure_gamma=5.0, backend='auto', quality='exact', tile_size=None, memory_budget=default_memory_budget):
+    '''Lens blur a large image tile by tile'''
+    return blur_tiled(
+        src,
+        lambda tile: lens_blur(tile, radius=radius, components=components, exposure_gamma=exposure_gamma, backend=backend, quality=quality),
+        get_halo(radius, quality),
+        dst=dst,
+        tile_size=tile_size,
+        kind='lens',
+        memory_budget=memory_budget
+    )
+
+def motion_blur_tiled(src, dst=None, size=100, angle=30, backend='auto', tile_size=None, memory_budget=default_memory_budget):
+    '''Motion blur a large image tile by tile'''
+    k = get_motion_kernel(size, angle)
+    # The FFT and spatial backends share a budget, only the rotated running sum needs more
+    kind = 'motion'
+    if choose_motion_backend(backend, k, size, 0) == 'box' and get_line_box(k) is None:
+        kind = 'motion_rotated'
+    return blur_tiled(
+        src,
+        lambda tile: motion_blur(tile, size=size, angle=angle, backend=backend),
+        size,
+        dst=dst,
+        tile_size=tile_size,
+        kind=kind,
+        memory_budget=memory_budget
+    )
+
+def gaussian_blur_tiled(src, dst=None, kernel=100, sigma=5, method='auto', tile_size=None, memory_budget=default_memory_budget):
+    '''Gaussian blur a large image tile by tile'''
+    return blur_tiled(
+        src,
+        lambda tile: gaussian_blur(tile, kernel, sigma=sigma, method=method),
+        kernel // 2 + 1,
+        dst=dst,
+        tile_size=tile_size,
+        kind='gaussian',
+        memory_budget=memory_budget
+    )
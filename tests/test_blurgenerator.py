@@ -1,6 +1,51 @@
+import os
+import sys
+import json
+import asyncio
 import unittest
+import threading
+import subprocess
+import urllib.request
+import importlib
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import numpy as np
 from blurgenerator import motion_blur, lens_blur, gaussian_blur
+from blurgenerator import motion_blur_with_depth_map, lens_blur_with_depth_map, gaussian_blur_with_depth_map
+from blurgenerator import RefocusSession
+from blurgenerator import motion_blur_batch, lens_blur_batch, gaussian_blur_with_depth_map_batch
+from blurgenerator.depth import blur_with_depth, label_depth_map, NO_LAYER
+from blurgenerator.kernel_cache import KernelCache
+from blurgenerator.convolution import fft_filter2d, spectrum_cache
+from blurgenerator import pool
+from blurgenerator import profiling
+from blurgenerator.profiling import profile
+from blurgenerator.result_cache import ResultCache
+from blurgenerator import aio
+from blurgenerator.serve import make_server
+from blurgenerator.stream import run_pipeline, blur_stream
+from blurgenerator.directory import find_tasks, run_directory
+from blurgenerator.tiled import lens_blur_tiled, motion_blur_tiled, gaussian_blur_tiled
+
+lens_module = importlib.import_module('blurgenerator.lens_blur')
+motion_module = importlib.import_module('blurgenerator.motion_blur')
+
+def make_depth_map(height=60, width=80):
+    gray = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    gray[20:40, 30:50] = 40
+    return np.repeat(gray[:, :, None], 3, axis=2)
+
+def full_frame_depth_blur(img, depth_map, blur_job, num_layers):
+    out = np.zeros_like(img)
+    for blur_amount, l_mask in blur_with_depth(depth_map, num_layers=num_layers):
+        mask = l_mask[:,:,0] > 100
+        out[mask] = blur_job(img, blur_amount)[mask]
+    return out
+
+def gaussian_jobs(kernel):
+    return lambda img: gaussian_blur(img, kernel), None
 
 class TestBlurGenerator(unittest.TestCase):
 
@@ -19,5 +64,466 @@ class TestBlurGenerator(unittest.TestCase):
         blur_img = gaussian_blur(rgb, kernel=3)
         self.assertFalse(np.array_equal(rgb, blur_img))
 
+    def test_kernel_cache_lru(self):
+        cache = KernelCache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 1)
+        cache.get('c', lambda: 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.info(), (1, 3, 2, 2))
+        cache.clear()
+        self.assertEqual(cache.info(), (0, 0, 2, 0))
+
+    def test_normalise_kernels(self):
+        params, scale = lens_module.get_parameters(component_count=3)
+        kernels = [lens_module.complex_kernel_1d(7, scale, p['a'], p['b']) for p in params]
+        normalised = lens_module.normalise_kernels(kernels, params)
+        total = 0
+        for k, p in zip(normalised, params):
+            kernel_2d = lens_module.multiply_kernel(k)
+            total += np.sum(lens_module.weighted_sum(kernel_2d, p))
+        self.assertAlmostEqual(total, 1.0, places=4)
+
+    def test_lens_blur_kernel_cache(self):
+        lens_module.clear_kernel_cache()
+        rgb = np.random.randint(255, size=(50, 50, 3),dtype=np.uint8)
+        first = lens_blur(rgb, radius=4)
+        second = lens_blur(rgb, radius=4)
+        self.assertTrue(np.array_equal(first, second))
+        info = lens_module.get_kernel_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+    def test_profile_stages(self):
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        with profile() as stats:
+            lens_blur(rgb, radius=3, backend='spatial')
+            gaussian_blur_with_depth_map(rgb, make_depth_map(), num_layers=5)
+        self.assertEqual(stats.stages['lens.filter_task'].calls, 5)
+        self.assertEqual(stats.stages['lens.convolve_spatial'].bytes, rgb.size * 4)
+        self.assertEqual(stats.stages['depth.labels'].calls, 1)
+        self.assertEqual(len(stats.layers), stats.stages['depth.blur'].calls)
+        calls = stats.stages['lens.gamma_encode'].calls
+        lens_blur(rgb, radius=3)
+        self.assertEqual(stats.stages['lens.gamma_encode'].calls, calls)
+
+    def test_profile_overlapping_threads(self):
+        rgb = np.random.randint(255, size=(40, 50, 3),dtype=np.uint8)
+        entered = threading.Event()
+        a_done = threading.Event()
+        results = {}
+
+        def thread_a():
+            with profile() as stats:
+                entered.wait()
+            results['a'] = stats
+            a_done.set()
+
+        def thread_b():
+            with profile() as stats:
+                entered.set()
+                a_done.wait()
+                gaussian_blur(rgb, 11)
+            results['b'] = stats
+
+        threads = [threading.Thread(target=thread_a), threading.Thread(target=thread_b)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(profiling.enabled())
+        self.assertIn('gaussian.exact', results['b'].stages)
+        self.assertNotIn('gaussian.exact', results['a'].stages)
+
+    def test_async_blur(self):
+        rgb = np.random.randint(255, size=(40, 50, 3),dtype=np.uint8)
+        aio.configure(max_concurrency=1)
+
+        async def blur_all():
+            return await asyncio.gather(*[aio.gaussian_blur_async(rgb, 11) for _ in range(3)])
+
+        for result in asyncio.run(blur_all()):
+            self.assertTrue(np.array_equal(result, gaussian_blur(rgb, 11)))
+        aio.configure(max_concurrency=os.cpu_count() or 1)
+
+    def test_serve_micro_batches(self):
+        rgb = np.random.randint(255, size=(40, 50, 3),dtype=np.uint8)
+        body = cv2.imencode('.png', rgb)[1].tobytes()
+        server = make_server(port=0, max_batch=4, max_delay=0.2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        results = []
+
+        def post():
+            request = urllib.request.Request(f'{url}/blur/gaussian?kernel=11', data=body, method='POST')
+            with urllib.request.urlopen(request) as response:
+                results.append(cv2.imdecode(np.frombuffer(response.read(), dtype=np.uint8), cv2.IMREAD_COLOR))
+
+        try:
+            threads = [threading.Thread(target=post) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            with urllib.request.urlopen(f'{url}/stats') as response:
+                stats = json.loads(response.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+            server.batcher.close()
+
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertTrue(np.array_equal(result, gaussian_blur(rgb, 11)))
+        self.assertEqual(stats['requests'], 4)
+        self.assertLess(stats['batches'], 4)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_lazy_import(self):
+        code = (
+            'import sys, blurgenerator\n'
+            'from blurgenerator.cli import main\n'
+            'sys.argv = ["blurgenerator", "--help"]\n'
+            'try:\n'
+            '    main()\n'
+            'except SystemExit:\n'
+            '    pass\n'
+            'assert "cv2" not in sys.modules and "numpy" not in sys.modules\n'
+            'import blurgenerator.lens_blur\n'
+            'assert callable(blurgenerator.lens_blur)\n'
+        )
+        subprocess.run([sys.executable, '-c', code], check=True, capture_output=True)
+
+    def test_motion_blur_with_depth_map(self):
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        depth_map = make_depth_map()
+        blur_img = motion_blur_with_depth_map(rgb, depth_map, num_layers=5)
+        expected = full_frame_depth_blur(rgb, depth_map, lambda img, size: motion_blur(img, size=size, angle=30), 5)
+        self.assertTrue(np.array_equal(blur_img, expected))
+
+    def test_gaussian_blur_with_depth_map(self):
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        depth_map = make_depth_map()
+        blur_img = gaussian_blur_with_depth_map(rgb, depth_map, num_layers=5)
+        expected = full_frame_depth_blur(rgb, depth_map, gaussian_blur, 5)
+        self.assertTrue(np.array_equal(blur_img, expected))
+
+    def test_lens_blur_with_depth_map_fast(self):
+        rgb = np.random.randint(255, size=(120, 160, 3),dtype=np.uint8)
+        depth_map = make_depth_map(120, 160)
+        blur_img = lens_blur_with_depth_map(rgb, depth_map, components=2, exposure_gamma=2, num_layers=5, quality='fast')
+        fast_blur = lambda img, radius: lens_blur(img, radius=radius, components=2, exposure_gamma=2, quality='fast')
+        expected = full_frame_depth_blur(rgb, depth_map, fast_blur, 5)
+        # Layers read the same halo as tiles, but a reduced crop is resampled on its own grid
+        self.assertLessEqual(np.abs(blur_img.astype(int) - expected).max(), 2)
+        self.assertEqual(lens_module.get_halo(40, 'fast'), 46)
+        self.assertEqual(lens_module.get_halo(40), 40)
+
+    @unittest.skipIf(sys.version_info < (3, 8), 'shared memory needs Python 3.8')
+    def test_depth_blur_process_pool(self):
+        from blurgenerator import processes
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        depth_map = make_depth_map()
+        expected = motion_blur_with_depth_map(rgb, depth_map, num_layers=5)
+        try:
+            blur_img = motion_blur_with_depth_map(rgb, depth_map, num_layers=5, processes=2)
+        finally:
+            processes.shutdown()
+        self.assertTrue(np.array_equal(blur_img, expected))
+
+    def test_label_depth_map(self):
+        depth_map = make_depth_map()
+        labels, blur_amounts = label_depth_map(depth_map, num_layers=5)
+        self.assertEqual(labels.dtype, np.uint8)
+        for blur_amount, l_mask in blur_with_depth(depth_map, num_layers=5):
+            mask = l_mask[:,:,0] > 100
+            label = blur_amounts.index(blur_amount)
+            self.assertTrue(np.all(labels[mask] == label))
+        self.assertTrue(np.all(labels[depth_map[:,:,0] == 0] == NO_LAYER))
+
+    def test_lens_blur_fft_backend(self):
+        rgb = np.random.randint(255, size=(50, 60, 3),dtype=np.uint8)
+        spatial = lens_blur(rgb, radius=8, backend='spatial')
+        fft = lens_blur(rgb, radius=8, backend='fft')
+        self.assertLessEqual(np.abs(spatial.astype(int) - fft).max(), 1)
+
+    def test_motion_blur_fft_backend(self):
+        rgb = np.random.randint(255, size=(50, 60, 3),dtype=np.uint8)
+        spatial = motion_blur(rgb, size=12, angle=20, backend='spatial')
+        fft = motion_blur(rgb, size=12, angle=20, backend='fft')
+        self.assertLessEqual(np.abs(spatial.astype(int) - fft).max(), 1)
+
+    def test_motion_blur_box_backend(self):
+        rgb = np.random.randint(255, size=(50, 60, 3),dtype=np.uint8)
+        for size, angle in [(9, 0), (9, 90), (12, 0), (12, 90)]:
+            spatial = motion_blur(rgb, size=size, angle=angle, backend='spatial')
+            box = motion_blur(rgb, size=size, angle=angle, backend='box')
+            self.assertLessEqual(np.abs(spatial.astype(int) - box).max(), 1)
+        smooth = cv2.GaussianBlur(rgb, (7, 7), 2)
+        spatial = motion_blur(smooth, size=21, angle=30, backend='spatial')
+        box = motion_blur(smooth, size=21, angle=30, backend='box')
+        self.assertLess(np.abs(spatial.astype(int) - box).mean(), 1)
+
+    def test_gaussian_blur_box_method(self):
+        rgb = cv2.GaussianBlur(np.random.randint(255, size=(60, 80, 3),dtype=np.uint8), (5, 5), 1)
+        exact = gaussian_blur(rgb, 101, method='exact')
+        box = gaussian_blur(rgb, 101, method='box')
+        self.assertLessEqual(np.abs(exact.astype(int) - box).max(), 5)
+        self.assertTrue(np.array_equal(gaussian_blur(rgb, 101), box))
+        self.assertTrue(np.array_equal(gaussian_blur(rgb, 101, sigma=1), gaussian_blur(rgb, 101, sigma=1, method='exact')))
+        self.assertTrue(np.array_equal(gaussian_blur(rgb, 11), gaussian_blur(rgb, 11, method='exact')))
+        with self.assertRaises(ValueError):
+            gaussian_blur(rgb, 11, method='iir')
+
+    def test_motion_blur_kernel_cache(self):
+        motion_module.clear_kernel_cache()
+        rgb = np.random.randint(255, size=(40, 40, 3),dtype=np.uint8)
+        motion_blur(rgb, size=7, angle=15)
+        motion_blur(rgb, size=7, angle=15)
+        info = motion_module.get_kernel_cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_unknown_backend(self):
+        rgb = np.random.randint(255, size=(50, 50, 3),dtype=np.uint8)
+        with self.assertRaises(ValueError):
+            lens_blur(rgb, backend='gpu')
+        with self.assertRaises(ValueError):
+            motion_blur(rgb, backend='gpu')
+
+    def test_lens_blur_batch(self):
+        frames = np.random.randint(255, size=(3, 40, 50, 3),dtype=np.uint8)
+        out = np.zeros_like(frames)
+        result = lens_blur_batch(frames, radius=4, out=out)
+        self.assertIs(result, out)
+        for frame, blur_img in zip(frames, out):
+            self.assertTrue(np.array_equal(blur_img, lens_blur(frame, radius=4)))
+
+    def test_motion_blur_batch_iterable(self):
+        frames = [np.random.randint(255, size=(40, 50, 3),dtype=np.uint8) for _ in range(3)]
+        result = motion_blur_batch(iter(frames), size=9, angle=45)
+        self.assertEqual(len(result), 3)
+        for frame, blur_img in zip(frames, result):
+            self.assertTrue(np.array_equal(blur_img, motion_blur(frame, size=9, angle=45)))
+
+    def test_gaussian_blur_with_depth_map_batch(self):
+        frames = np.random.randint(255, size=(2, 60, 80, 3),dtype=np.uint8)
+        depth_maps = np.stack([make_depth_map(), make_depth_map()[:, ::-1]])
+        result = gaussian_blur_with_depth_map_batch(frames, depth_maps, num_layers=4)
+        for frame, depth_map, blur_img in zip(frames, depth_maps, result):
+            self.assertTrue(np.array_equal(blur_img, gaussian_blur_with_depth_map(frame, depth_map, num_layers=4)))
+
+    def test_shared_pool_nested_calls(self):
+        rgb = np.random.randint(255, size=(40, 50, 3),dtype=np.uint8)
+        expected = lens_blur(rgb, radius=3, backend='spatial')
+        pool.configure(max_workers=2)
+        try:
+            results = pool.run_tasks(lambda: lens_blur(rgb, radius=3, backend='spatial'), [()] * 4)
+        finally:
+            pool.configure(max_workers=pool.default_max_workers)
+        for blur_img in results:
+            self.assertTrue(np.array_equal(blur_img, expected))
+
+    def test_caller_executor_nested_calls(self):
+        rgb = np.random.randint(255, size=(40, 50, 3),dtype=np.uint8)
+        expected = lens_blur(rgb, radius=3, backend='spatial')
+        with ThreadPoolExecutor(2) as executor:
+            pool.configure(executor=executor)
+            try:
+                tasks = [executor.submit(lens_blur, rgb, radius=3, backend='spatial') for _ in range(4)]
+                tasks += [executor.submit(lens_blur, rgb, radius=3, backend='spatial', executor=executor) for _ in range(4)]
+                results = [task.result(timeout=20) for task in tasks]
+            finally:
+                pool.configure(max_workers=pool.default_max_workers)
+        for blur_img in results:
+            self.assertTrue(np.array_equal(blur_img, expected))
+
+    def test_lens_blur_precision(self):
+        rgb = np.random.randint(255, size=(50, 50, 3),dtype=np.uint8)
+        single = lens_blur(rgb, radius=4, precision='float32')
+        double = lens_blur(rgb, radius=4, precision='float64')
+        self.assertEqual(single.dtype, np.uint8)
+        self.assertLessEqual(np.abs(single.astype(int) - double).max(), 1)
+        single = lens_blur(rgb, radius=8, precision='float32', backend='fft')
+        double = lens_blur(rgb, radius=8, precision='float64', backend='fft')
+        self.assertLessEqual(np.abs(single.astype(int) - double).max(), 1)
+        plane = np.random.rand(30, 40).astype(np.float32)
+        kernel = np.random.rand(7, 7).astype(np.float32)
+        filtered = fft_filter2d(plane, kernel)
+        self.assertEqual(filtered.dtype, np.float32)
+        self.assertTrue(np.allclose(filtered, cv2.filter2D(plane, -1, kernel), atol=1e-4))
+        with self.assertRaises(ValueError):
+            lens_blur(rgb, precision='float16')
+
+    def test_lens_blur_fast_quality(self):
+        rgb = cv2.GaussianBlur(np.random.randint(255, size=(240, 320, 3),dtype=np.uint8), (0, 0), 3)
+        rgb[100:104, 150:154] = 255
+        for radius in [20, 40]:
+            exact = lens_blur(rgb, radius=radius, components=4, exposure_gamma=2)
+            fast = lens_blur(rgb, radius=radius, components=4, exposure_gamma=2, quality='fast')
+            mse = np.mean((exact.astype(np.float64) - fast) ** 2)
+            self.assertGreater(10 * np.log10(255 ** 2 / mse), 40)
+        small = lens_blur(rgb, radius=5, quality='fast')
+        self.assertTrue(np.array_equal(small, lens_blur(rgb, radius=5)))
+        with self.assertRaises(ValueError):
+            lens_blur(rgb, quality='draft')
+
+    def test_tiled_blur_matches_full_frame(self):
+        rgb = np.random.randint(255, size=(150, 170, 3),dtype=np.uint8)
+        tiled = lens_blur_tiled(rgb, radius=5, backend='spatial', tile_size=64)
+        self.assertTrue(np.array_equal(tiled, lens_blur(rgb, radius=5, backend='spatial')))
+        tiled = motion_blur_tiled(rgb, size=15, angle=30, tile_size=64)
+        self.assertTrue(np.array_equal(tiled, motion_blur(rgb, size=15, angle=30)))
+        tiled = gaussian_blur_tiled(rgb, kernel=21, tile_size=64)
+        self.assertTrue(np.array_equal(tiled, gaussian_blur(rgb, 21)))
+
+    def test_spectrum_cache_bytes(self):
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        spectrum_cache.clear()
+        lens_blur(rgb, radius=8, backend='fft')
+        lens_blur(rgb[:40], radius=8, backend='fft')
+        info = spectrum_cache.info()
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.currsize, sum(spectrum.nbytes for spectrum in spectrum_cache._data.values()))
+        spectrum_cache.resize(info.currsize - 1)
+        self.assertEqual(len(spectrum_cache), 1)
+        spectrum_cache.resize(64 * 2**20)
+
+    def test_tiled_blur_memmap(self):
+        rgb = np.random.randint(255, size=(100, 120, 3),dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as folder:
+            src = os.path.join(folder, 'src.npy')
+            dst = os.path.join(folder, 'dst.npy')
+            np.save(src, rgb)
+            out = gaussian_blur_tiled(src, dst, kernel=11, memory_budget=2**16)
+            self.assertIsInstance(out, np.memmap)
+            del out
+            self.assertTrue(np.array_equal(np.load(dst), gaussian_blur(rgb, 11)))
+
+    def test_tiled_motion_blur_memory_budget(self):
+        rgb = np.random.randint(255, size=(800, 800, 3),dtype=np.uint8)
+        out = np.empty_like(rgb)
+        budget = 16 * 2**20
+        tracemalloc.start()
+        try:
+            motion_blur_tiled(rgb, out, size=100, angle=30, backend='box', memory_budget=budget)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLessEqual(peak, budget)
+
+    def test_run_pipeline_keeps_order(self):
+        written = []
+        count = run_pipeline(iter(range(50)), lambda value: value * 2, written.append, prefetch=2, workers=3)
+        self.assertEqual(count, 50)
+        self.assertEqual(written, [value * 2 for value in range(50)])
+
+    def test_run_pipeline_forwards_errors(self):
+        def blur_job(value):
+            if value == 5:
+                raise RuntimeError('broken frame')
+            return value
+        with self.assertRaises(RuntimeError):
+            run_pipeline(iter(range(20)), blur_job, lambda frame: None, prefetch=2, workers=2)
+
+    def test_blur_stream_with_depth(self):
+        with tempfile.TemporaryDirectory() as folder:
+            frames = os.path.join(folder, 'frames')
+            depth_frames = os.path.join(folder, 'depth')
+            os.mkdir(frames)
+            os.mkdir(depth_frames)
+            for idx in range(4):
+                cv2.imwrite(os.path.join(frames, f'{idx:03d}.png'), np.random.randint(255, size=(60, 80, 3),dtype=np.uint8))
+                cv2.imwrite(os.path.join(depth_frames, f'{idx:03d}.png'), make_depth_map())
+            output = os.path.join(folder, 'output.avi')
+            count, _ = blur_stream(frames, output, lambda img, depth_map: gaussian_blur_with_depth_map(img, depth_map, num_layers=3), depth_src=depth_frames)
+            self.assertEqual(count, 4)
+            capture = cv2.VideoCapture(output)
+            self.assertEqual(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), 4)
+            capture.release()
+
+    def test_directory_batch(self):
+        with tempfile.TemporaryDirectory() as folder:
+            input_dir = os.path.join(folder, 'input')
+            output_dir = os.path.join(folder, 'output')
+            os.mkdir(input_dir)
+            for idx in range(3):
+                cv2.imwrite(os.path.join(input_dir, f'{idx}.png'), np.random.randint(255, size=(40, 50, 3),dtype=np.uint8))
+            tasks, skipped = find_tasks(input_dir, output_dir, '*.png')
+            self.assertEqual((len(tasks), skipped), (3, 0))
+            summary = run_directory(tasks, gaussian_jobs, 5, workers=2)
+            self.assertEqual((summary.images, summary.failed), (3, []))
+            for src, dst, _ in tasks:
+                self.assertTrue(np.array_equal(cv2.imread(str(dst)), gaussian_blur(cv2.imread(str(src)), 5)))
+            tasks, skipped = find_tasks(input_dir, output_dir, '*.png')
+            self.assertEqual((len(tasks), skipped), (0, 3))
+
+    def test_continuous_depth_blur(self):
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        depth_map = make_depth_map()
+        blur_img = gaussian_blur_with_depth_map(rgb, depth_map, min_blur=1, max_blur=21, continuous=True, num_levels=3)
+        near = depth_map[:,:,0] == 0
+        far = depth_map[:,:,0] == 255
+        middle = depth_map[:,:,0] == 40
+        self.assertTrue(np.array_equal(blur_img[near], gaussian_blur(rgb, 1)[near]))
+        self.assertTrue(np.array_equal(blur_img[far], gaussian_blur(rgb, 21)[far]))
+        t = (40 / 255 * 20) / 10
+        between = (1 - t) * gaussian_blur(rgb, 1) + t * gaussian_blur(rgb, 11).astype(float)
+        self.assertLessEqual(np.abs(blur_img[middle] - np.rint(between[middle])).max(), 1)
+
+    def test_result_cache(self):
+        rgb = np.random.randint(255, size=(40, 50, 3),dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ResultCache(folder)
+            first = cache.call(lens_blur, rgb, radius=3)
+            second = cache.call(lens_blur, rgb, radius=3)
+            self.assertTrue(np.array_equal(first, second))
+            self.assertTrue(np.array_equal(first, lens_blur(rgb, radius=3)))
+            cache.call(lens_blur, rgb, radius=4)
+            info = cache.info()
+            self.assertEqual((info.hits, info.misses), (1, 2))
+            self.assertEqual(info.currsize, 2 * (first.nbytes + 128))
+            cache.resize(first.nbytes + 128)
+            self.assertEqual(cache.info().currsize, first.nbytes + 128)
+            # Another instance starts from the size on disk, and a rewritten entry counts once
+            other = ResultCache(folder, max_bytes=4 * first.nbytes)
+            self.assertEqual(other.info().currsize, first.nbytes + 128)
+            other.call(lens_blur, rgb, radius=5)
+            other.put(other.key('blurgenerator.lens_blur.lens_blur', [rgb], {'radius': 5}), first)
+            self.assertEqual(other.info().currsize, 2 * (first.nbytes + 128))
+
+    def test_refocus_session(self):
+        rgb = np.random.randint(255, size=(60, 80, 3),dtype=np.uint8)
+        depth_map = make_depth_map()
+        session = RefocusSession(rgb, depth_map, components=2, exposure_gamma=2)
+        blur_img = session.render(num_layers=5, min_blur=1, max_blur=6)
+        expected = lens_blur_with_depth_map(rgb, depth_map, components=2, exposure_gamma=2, num_layers=5, min_blur=1, max_blur=6)
+        # The layers of the depth blur leave the nearest depth black
+        layered = depth_map[:, :, 0] > 0
+        # Full-frame and bounding box blurs may round a pixel differently
+        self.assertLessEqual(np.abs(blur_img[layered].astype(int) - expected[layered]).max(), 1)
+        self.assertTrue(np.array_equal(blur_img[~layered], session.blur(1)[~layered]))
+        frames = list(session.sweep(range(0, 256, 16), num_layers=5, min_blur=1, max_blur=6))
+        self.assertEqual(len(frames), 16)
+        info = session.info()
+        self.assertLessEqual(info.misses, 6)
+        self.assertEqual(info.currsize, info.misses * rgb.nbytes)
+        session.resize(2 * rgb.nbytes)
+        self.assertEqual(session.info().currsize, 2 * rgb.nbytes)
+
+    def test_refocus_session_focal_plane(self):
+        rgb = np.random.randint(64, 255, size=(60, 80, 3),dtype=np.uint8)
+        depth_map = make_depth_map()
+        focus = int(depth_map[0, 40, 0])
+        session = RefocusSession(rgb, depth_map, components=2, exposure_gamma=2)
+        blur_img = session.render(focus=focus, num_layers=5, max_blur=6)
+        in_focus = depth_map[:, :, 0] == focus
+        self.assertTrue(in_focus.any())
+        self.assertTrue(np.all(blur_img[in_focus].max(axis=1) > 0))
+        self.assertTrue(np.array_equal(blur_img[in_focus], session.blur(1)[in_focus]))
+        self.assertEqual(session.render(focus=focus, num_layers=200, max_blur=6).shape, rgb.shape)
+        with self.assertRaises(ValueError):
+            session.render(focus=300)
+
 if __name__ == '__main__':
     unittest.main()